@@ -0,0 +1,158 @@
+"""Write a synthetic register, in the layout of the org-id/register repository.
+
+Creates schema/ with the codelists the List Finder uses and lists/ with one
+JSON file per organisation identifier list, so it can be loaded with
+LOCAL_DATA=True and LOCAL_DATA_DIR pointing at the output directory.
+
+Lists are spread over countries with a long tail, as in the real register:
+a few countries have many lists and most have one or two. Some lists cover
+many countries, some cover regions, and structure, sector, availability and
+license are filled in at roughly the rates seen in the register.
+
+    python benchmarks/generate_register.py /tmp/register --lists 10000
+"""
+import argparse
+import json
+import os
+import random
+import string
+
+SECTORS = [
+    'education', 'health', 'charity', 'government', 'finance', 'transport',
+    'religion', 'sport', 'culture', 'environment', 'research', 'agriculture',
+]
+
+STRUCTURES = {
+    'company': ['limited_company', 'public_limited_company', 'cooperative', 'partnership', 'sole_trader'],
+    'charity': ['trust', 'incorporated', 'unincorporated'],
+    'government_agency': ['local', 'regional', 'national'],
+    'education': ['school', 'university'],
+    'nonprofit': ['association', 'foundation'],
+    'multilateral': [],
+}
+
+AVAILABILITY = [('api', 10), ('bulk', 10), ('csv', 5), ('excel', 5), ('pdf', 1), ('web', 2)]
+LICENSE_STATUS = [('open_license', 20), ('closed_license', 5), ('no_license', 0), ('unknown', 0)]
+LIST_TYPES = [('primary', 50), ('secondary', 30), ('third_party', 20), ('local', 10), ('dataset', 5)]
+
+COUNTRIES = 250
+COUNTRIES_WITH_REGIONS = 40
+REGIONS_PER_COUNTRY = 8
+
+
+def country_codes():
+    return [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase][:COUNTRIES]
+
+
+def make_schemas(countries):
+    subnational = [
+        {'code': '{}-R{}'.format(country, i), 'countryCode': country, 'title': {'en': 'Region {} of {}'.format(i, country)}}
+        for country in countries[:COUNTRIES_WITH_REGIONS]
+        for i in range(REGIONS_PER_COUNTRY)
+    ]
+    structure = []
+    for parent, children in STRUCTURES.items():
+        title = parent.replace('_', ' ').title()
+        structure.append({'code': parent, 'title': {'en': title}, 'parent': ''})
+        for child in children:
+            structure.append({
+                'code': '{}/{}'.format(parent, child),
+                'title': {'en': '{} > {}'.format(title, child.replace('_', ' ').title())},
+                'parent': parent,
+            })
+    return {
+        'codelist-coverage': {
+            'coverage': [{'code': country, 'title': {'en': 'Country ' + country}} for country in countries],
+            'subnationalCoverage': subnational,
+        },
+        'codelist-structure': {'structure': structure},
+        'codelist-sector': {'sector': [{'code': sector, 'title': {'en': sector.title()}} for sector in SECTORS]},
+        'codelist-availability': {
+            'availability': [{'code': code, 'title': {'en': code.upper()}, 'quality_score': score} for code, score in AVAILABILITY]
+        },
+        'codelist-licenseStatus': {
+            'licenseStatus': [{'code': code, 'title': {'en': code.replace('_', ' ')}, 'quality_score': score} for code, score in LICENSE_STATUS]
+        },
+        'codelist-listType': {
+            'listType': [{'code': code, 'title': {'en': code}, 'quality_score': score} for code, score in LIST_TYPES]
+        },
+    }
+
+
+def make_org_id_list(rnd, number, countries, schemas):
+    # Countries are picked with a long tail, and about one list in ten is not for a country
+    if rnd.random() < 0.1:
+        country = None
+        coverage = None
+    else:
+        country = countries[min(int(rnd.paretovariate(1.2)) - 1, len(countries) - 1)]
+        coverage = [country]
+        if rnd.random() < 0.1:
+            coverage = sorted(set(coverage + rnd.sample(countries, rnd.randint(1, 40))))
+
+    subnational = None
+    if coverage == [country] and countries.index(country) < COUNTRIES_WITH_REGIONS and rnd.random() < 0.2:
+        regions = ['{}-R{}'.format(country, i) for i in range(REGIONS_PER_COUNTRY)]
+        subnational = rnd.sample(regions, rnd.randint(1, len(regions)))
+
+    structure_codes = [item['code'] for item in schemas['codelist-structure']['structure']]
+    code = '{}-{}{}'.format(country or 'XI', ''.join(rnd.choice(string.ascii_uppercase) for _ in range(3)), number)
+    return {
+        'name': {'en': 'Register {} of organisations'.format(number), 'local': 'Registro {}'.format(number)},
+        'description': {'en': 'A register of organisations. Listing number {}. Maintained by a government body.'.format(number)},
+        'code': code,
+        'url': 'http://example.com/{}'.format(number),
+        'coverage': coverage,
+        'subnationalCoverage': subnational,
+        'structure': rnd.sample(structure_codes, rnd.randint(1, 2)) if rnd.random() < 0.8 else None,
+        'sector': rnd.sample(SECTORS, rnd.randint(1, 3)) if rnd.random() < 0.35 else None,
+        'listType': rnd.choice([code for code, score in LIST_TYPES]),
+        'access': {
+            'availableOnline': rnd.random() < 0.7,
+            'onlineAccessDetails': 'Search by name or number on the website',
+            'publicDatabase': 'http://example.com/{}/search'.format(number),
+            'guidanceOnLocatingIds': 'The number is shown on the record page',
+            'exampleIdentifiers': '{0:08d}, {1:08d}'.format(number, number + 1),
+            'languages': ['en'],
+        },
+        'data': {
+            'availability': rnd.sample([code for code, score in AVAILABILITY], rnd.randint(0, 3)),
+            'dataAccessDetails': 'Bulk data is published monthly',
+            'features': ['legal_entity_type'],
+            'licenseStatus': rnd.choice([code for code, score in LICENSE_STATUS] + [None]),
+            'licenseDetails': 'See the terms of use',
+        },
+        'meta': {'source': 'Synthetic register', 'lastUpdated': '2017-01-01'},
+        'links': {'opencorporates': None, 'wikipedia': ''},
+        'confirmed': rnd.random() < 0.9,
+        'deprecated': rnd.random() < 0.05,
+        'formerPrefixes': ['OLD-{}'.format(number)] if rnd.random() < 0.1 else [],
+    }
+
+
+def generate(directory, lists=1000, seed=0):
+    '''Write a register of the given number of lists to directory'''
+    rnd = random.Random(seed)
+    countries = country_codes()
+    schemas = make_schemas(countries)
+
+    os.makedirs(os.path.join(directory, 'schema'), exist_ok=True)
+    for name, schema in schemas.items():
+        with open(os.path.join(directory, 'schema', name + '.json'), 'w') as schema_file:
+            json.dump(schema, schema_file, indent=2)
+
+    for number in range(lists):
+        org_id_list = make_org_id_list(rnd, number, countries, schemas)
+        list_dir = os.path.join(directory, 'lists', org_id_list['code'].split('-')[0].lower())
+        os.makedirs(list_dir, exist_ok=True)
+        with open(os.path.join(list_dir, org_id_list['code'].lower() + '.json'), 'w') as list_file:
+            json.dump(org_id_list, list_file, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory')
+    parser.add_argument('--lists', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.directory, args.lists, args.seed)
@@ -0,0 +1,124 @@
+"""Compare the memory taken by organisation lists as parsed and as compact records.
+
+A register is generated (see generate_register.py) and its lists are read
+and augmented as refresh_data does, then kept as ListRecords as
+RegisterSnapshot does. For each form this reports the size of the lists
+and everything they reference (counting shared objects once), the memory
+allocated while building them, and the size of the lists pickled, as in
+shared snapshots:
+
+    python benchmarks/memory_report.py --lists 10000 --data-dir /tmp/registers
+
+Sizes are in bytes.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import generate_register
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+os.environ['LOCAL_DATA'] = 'True'
+os.environ['SHARED_SNAPSHOT_DIR'] = ''
+os.environ['REFRESH_INTERVAL'] = '0'
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'prefix_finder.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from prefix_finder.frontend import views  # noqa: E402
+from prefix_finder.frontend.records import Compactor, to_plain  # noqa: E402
+from prefix_finder.frontend.store import estimate_size  # noqa: E402
+
+
+def traced(function, *args):
+    '''Call function, returning its result, the bytes it left allocated and the seconds it took'''
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - started
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, allocated, seconds
+
+
+def read_lists():
+    with contextlib.redirect_stdout(io.StringIO()):
+        schemas, org_id_lists, sources = views.read_register(views.iter_disk_files())
+        views.augment_quality(schemas, org_id_lists)
+        views.augment_structure(org_id_lists)
+    return org_id_lists
+
+
+def compact_lists(org_id_lists):
+    compactor = Compactor()
+    return [compactor.compact(org_id_list) for org_id_list in org_id_lists]
+
+
+def measure(name, org_id_lists, allocated, seconds):
+    return {
+        'form': name,
+        'lists': len(org_id_lists),
+        'estimated_size': estimate_size(org_id_lists),
+        'allocated': allocated,
+        'pickled_size': len(pickle.dumps(org_id_lists, pickle.HIGHEST_PROTOCOL)),
+        'seconds': seconds,
+    }
+
+
+def report(directory):
+    settings.LOCAL_DATA_DIR = directory
+    plain, allocated, seconds = traced(read_lists)
+    results = [measure('parsed', plain, allocated, seconds)]
+    compact, allocated, seconds = traced(compact_lists, plain)
+    if [to_plain(record) for record in compact] != plain:
+        raise AssertionError('Compact records do not match the lists they were made from')
+    # Measured without the parsed lists, which are only needed to build them
+    del plain
+    results.append(measure('compact', compact, allocated, seconds))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lists', type=int, default=10000, help='number of lists to generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='keep generated registers here and reuse them on later runs')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if args.data_dir:
+            directory = os.path.join(args.data_dir, '{}-{}'.format(args.lists, args.seed))
+        else:
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+        if not os.path.isdir(os.path.join(directory, 'lists')):
+            print('Generating {} lists'.format(args.lists), file=sys.stderr)
+            generate_register.generate(directory, args.lists, args.seed)
+        results = report(directory)
+
+    print('{:<8} {:>7} {:>15} {:>15} {:>15} {:>9}'.format('form', 'lists', 'estimated_size', 'allocated', 'pickled_size', 'seconds'))
+    for result in results:
+        print('{form:<8} {lists:>7} {estimated_size:>15,} {allocated:>15,} {pickled_size:>15,} {seconds:>9.3f}'.format(**result))
+    parsed, compact = results
+    print('compact is {:.1%} of parsed by estimated size'.format(compact['estimated_size'] / parsed['estimated_size']))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""Time the List Finder against synthetic registers of different sizes.
+
+For each size a register is generated (see generate_register.py), loaded
+from disk with refresh_data (from scratch, then again as a reload that
+reuses the unchanged lists), and then the query functions, downloads and
+template filters are timed on it. The results are written as JSON, so runs
+on different commits can be compared:
+
+    python benchmarks/run_benchmarks.py --sizes 100 1000 10000 --output before.json
+    python benchmarks/run_benchmarks.py --sizes 100 1000 10000 --compare before.json
+
+All times are in seconds.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate_register
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+# Load from disk only, without sharing snapshots or refreshing in the background
+os.environ['LOCAL_DATA'] = 'True'
+os.environ['SHARED_SNAPSHOT_DIR'] = ''
+os.environ['REFRESH_INTERVAL'] = '0'
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'prefix_finder.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+
+from prefix_finder.frontend import views  # noqa: E402
+from prefix_finder.frontend.store import SnapshotStore  # noqa: E402
+from prefix_finder.frontend.templatetags.results import tidy_results  # noqa: E402
+
+BRANCH = 'benchmark'
+# Upper limit on the lists add_titles and tidy_results are timed over, per repeat
+MAX_ITEMS = 2000
+
+
+def summarise(name, lists, times):
+    times = sorted(times)
+    return {
+        'benchmark': name,
+        'lists': lists,
+        'calls': len(times),
+        'total': sum(times),
+        'mean': statistics.mean(times),
+        'median': statistics.median(times),
+        'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+        'min': times[0],
+        'max': times[-1],
+    }
+
+
+def add_titles(org_list, lookups):
+    '''Add the titles of its codes to a list, as was done for each result before titles were built with the snapshot'''
+    org_list.update(views.build_titles(lookups, [org_list])[org_list['code']])
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+
+def make_queries(lookups, count, seed):
+    '''Queries like those made from the home page, some with every dropdown set'''
+    rnd = random.Random(seed)
+    subnational = [item[0] for items in lookups['subnational'].values() for item in items]
+    substructure = [item[0] for items in lookups['substructure'].values() for item in items]
+    queries = [{}]
+    while len(queries) < count:
+        query = {}
+        if rnd.random() < 0.8:
+            query['coverage'] = rnd.choice(lookups['coverage'])[0]
+        if rnd.random() < 0.2 and subnational:
+            query['subnational'] = rnd.choice(subnational)
+        if rnd.random() < 0.6:
+            query['structure'] = rnd.choice(lookups['structure'])[0]
+        if rnd.random() < 0.2 and substructure:
+            query['substructure'] = rnd.choice(substructure)
+        if rnd.random() < 0.4:
+            query['sector'] = rnd.choice(lookups['sector'])[0]
+        queries.append(query)
+    return queries
+
+
+def download(view, request, snapshot):
+    snapshot.artifacts.clear()
+    response = view(request)
+    if response.streaming:
+        for chunk in response.streaming_content:
+            pass
+    else:
+        response.content
+
+
+def run_size(directory, lists, args):
+    settings.LOCAL_DATA_DIR = directory
+    results = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        times = []
+        for _ in range(args.repeat):
+            # Start afresh, as lists already loaded would be reused
+            views.snapshots = SnapshotStore()
+            times.append(timed(views.refresh_data, BRANCH))
+        results.append(summarise('refresh_data', lists, times))
+        # Reloading the unchanged register, which stops once it finds no file has changed
+        times = [timed(views.refresh_data, BRANCH) for _ in range(args.repeat)]
+        results.append(summarise('refresh_data_incremental', lists, times))
+    snapshot = views.snapshots.peek(BRANCH)
+
+    queries = make_queries(snapshot.lookups, args.queries, args.seed)
+    times = [timed(views.filter_and_score_results, query, snapshot) for query in queries for _ in range(args.repeat)]
+    results.append(summarise('filter_and_score_results', lists, times))
+    times = [timed(views.get_lookups, query, snapshot) for query in queries if query for _ in range(args.repeat)]
+    results.append(summarise('get_lookups', lists, times))
+
+    org_id_lists = list(snapshot.lists.values())[:MAX_ITEMS]
+    # What someone might type while looking for a list, a word at a time
+    names = [org_list['name']['en'] for org_list in org_id_lists[:args.queries] if (org_list.get('name') or {}).get('en')]
+    searches = [name[:length] for name in names for length in (1, 3, len(name))]
+    times = [timed(snapshot.search.search, text, 10) for text in searches for _ in range(args.repeat)]
+    results.append(summarise('search', lists, times))
+    times = [timed(add_titles, dict(org_list), snapshot.lookups) for org_list in org_id_lists for _ in range(args.repeat)]
+    results.append(summarise('add_titles', lists, times))
+
+    scored = views.filter_and_score_results({}, snapshot)
+    scored = (scored['suggested'] + scored['recommended'] + scored['other'])[:MAX_ITEMS]
+    for length in (None, 'long'):
+        times = [timed(lambda result: list(tidy_results(result, length)), result) for result in scored for _ in range(args.repeat)]
+        results.append(summarise('tidy_results' + ('_long' if length else ''), lists, times))
+
+    request = RequestFactory().get('/download.csv')
+    request.session = {'branch': BRANCH}
+    times = [timed(download, views.csv_download, request, snapshot) for _ in range(args.repeat)]
+    results.append(summarise('csv_download', lists, times))
+    request = RequestFactory().get('/download.csv', {'fields': 'code,name/en,coverage,quality'})
+    request.session = {'branch': BRANCH}
+    times = [timed(download, views.csv_download, request, snapshot) for _ in range(args.repeat)]
+    results.append(summarise('csv_download_fields', lists, times))
+
+    times = [timed(views.make_xml_codelist, snapshot) for _ in range(args.repeat)]
+    results.append(summarise('make_xml_codelist', lists, times))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, previous):
+    before = {(result['benchmark'], result['lists']): result['median'] for result in previous['results']}
+    print('{:<28} {:>7} {:>12} {:>12} {:>8}'.format('benchmark', 'lists', 'before', 'after', 'ratio'))
+    for result in report['results']:
+        old = before.get((result['benchmark'], result['lists']))
+        if old is None:
+            continue
+        print('{:<28} {:>7} {:>12.6f} {:>12.6f} {:>8.2f}'.format(
+            result['benchmark'], result['lists'], old, result['median'], result['median'] / old if old else float('inf')
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='numbers of lists to generate')
+    parser.add_argument('--repeat', type=int, default=3, help='times to repeat each measurement')
+    parser.add_argument('--queries', type=int, default=100, help='number of different queries to time')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='keep generated registers here and reuse them on later runs')
+    parser.add_argument('--output', help='file to write the JSON report to, otherwise it is printed')
+    parser.add_argument('--compare', help='earlier JSON report to compare medians with')
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'sizes': args.sizes, 'repeat': args.repeat, 'queries': args.queries, 'seed': args.seed},
+        'scoring_engine': settings.SCORING_ENGINE,
+        'results': [],
+    }
+    for lists in args.sizes:
+        with contextlib.ExitStack() as stack:
+            if args.data_dir:
+                directory = os.path.join(args.data_dir, '{}-{}'.format(lists, args.seed))
+            else:
+                directory = stack.enter_context(tempfile.TemporaryDirectory())
+            if not os.path.isdir(os.path.join(directory, 'lists')):
+                print('Generating {} lists'.format(lists), file=sys.stderr)
+                generate_register.generate(directory, lists, args.seed)
+            print('Timing {} lists'.format(lists), file=sys.stderr)
+            report['results'].extend(run_size(directory, lists, args))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(report, json.load(previous))
+
+
+if __name__ == '__main__':
+    main()
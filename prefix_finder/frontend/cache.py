@@ -0,0 +1,71 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+
+class QueryCache:
+    '''Bounded LRU cache for the results of pure query functions.
+
+    Keys are tuples starting with the branch name, so everything for a
+    branch can be dropped when it is reloaded. If backend names a Django
+    cache, it is used as a second level shared between processes.
+    '''
+
+    def __init__(self, maxsize=1024, backend=None):
+        self.maxsize = maxsize
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _backend_key(self, key):
+        return 'org-id-query:' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get_or_set(self, key, compute):
+        '''Return the value cached for key, calling compute() to fill it on a miss'''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        value = None
+        if self.backend:
+            value = caches[self.backend].get(self._backend_key(key))
+        hit = value is not None
+        if not hit:
+            value = compute()
+            if self.backend:
+                caches[self.backend].set(self._backend_key(key), value)
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if self.maxsize:
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, branch=None):
+        '''Drop the entries for branch, or everything if no branch is given'''
+        with self._lock:
+            if branch is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if key[0] == branch]:
+                    del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
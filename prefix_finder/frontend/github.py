@@ -0,0 +1,65 @@
+import datetime
+import shutil
+import tempfile
+
+from django.conf import settings
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_session = None
+
+
+def get_session():
+    '''Get the requests session shared by all calls to GitHub, with retries and backoff'''
+    global _session
+    if _session is None:
+        retry = Retry(
+            total=settings.GITHUB_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('GET',),
+        )
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(max_retries=retry))
+        session.mount('http://', HTTPAdapter(max_retries=retry))
+        if settings.GITHUB_USER and settings.GITHUB_API_TOKEN:
+            session.auth = (settings.GITHUB_USER, settings.GITHUB_API_TOKEN)
+        _session = session
+    return _session
+
+
+def get_branch_commit(branch="main"):
+    '''Get the sha of the latest commit of a branch, and when it was committed'''
+    url = settings.GITHUB_BRANCH_API_URL.format(branch=branch)
+    response = get_session().get(url, timeout=settings.GITHUB_TIMEOUT)
+    response.raise_for_status()
+    commit = response.json()['commit']
+    committed_at = datetime.datetime.strptime(commit['commit']['committer']['date'], '%Y-%m-%dT%H:%M:%SZ')
+    return commit['sha'], committed_at.replace(tzinfo=datetime.timezone.utc)
+
+
+def fetch_archive(branch="main", etag=None):
+    '''Download the zip archive of a branch into a temporary file.
+
+    Returns (file, etag). If etag is given and the archive has not changed
+    since, GitHub answers 304 and file is None. The caller should close the
+    file, which removes it.
+    '''
+    url = settings.GITHUB_ARCHIVE_URL.format(branch=branch)
+    headers = {'If-None-Match': etag} if etag else {}
+    response = get_session().get(url, headers=headers, stream=True, timeout=settings.GITHUB_TIMEOUT)
+    with response:
+        if response.status_code == 304:
+            return None, etag
+        response.raise_for_status()
+        archive = tempfile.TemporaryFile()
+        try:
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, archive)
+        except Exception:
+            archive.close()
+            raise
+    archive.seek(0)
+    return archive, response.headers.get('ETag')
@@ -0,0 +1,60 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Files handed to a worker thread at a time
+CHUNK_SIZE = 64
+
+
+def loads(content):
+    '''Parse JSON from bytes, giving the same result as json.loads but with orjson when it is installed'''
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson is stricter, e.g. about NaN or integers over 64 bits, so
+            # leave json to accept those or raise its own error
+            pass
+    return json.loads(content.decode('utf-8'))
+
+
+def map_chunks(function, items, workers):
+    '''Get function(chunk) for chunks of items, with up to workers threads, in order'''
+    chunks = [items[start:start + CHUNK_SIZE] for start in range(0, len(items), CHUNK_SIZE)]
+    if workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(min(workers, len(chunks))) as pool:
+            return list(pool.map(function, chunks))
+    return [function(chunk) for chunk in chunks]
+
+
+def _parse_chunk(reads):
+    parsed = []
+    read_seconds = decode_seconds = 0
+    for read in reads:
+        started = time.perf_counter()
+        content = read()
+        read_at = time.perf_counter()
+        parsed.append(loads(content))
+        read_seconds += read_at - started
+        decode_seconds += time.perf_counter() - read_at
+    return parsed, read_seconds, decode_seconds
+
+
+def parse_files(reads, workers=1):
+    '''Read and parse JSON files, given a function to read each, with up to workers threads.
+
+    Returns the parsed files in order, and the seconds spent reading and
+    decoding, added up over the threads.
+    '''
+    parsed = []
+    read_seconds = decode_seconds = 0
+    for chunk_parsed, chunk_read, chunk_decode in map_chunks(_parse_chunk, list(reads), workers):
+        parsed.extend(chunk_parsed)
+        read_seconds += chunk_read
+        decode_seconds += chunk_decode
+    return parsed, read_seconds, decode_seconds
@@ -0,0 +1,100 @@
+import datetime
+import fcntl
+import os
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+
+
+def _git(*args):
+    return subprocess.run(
+        ['git', '--git-dir', settings.GIT_MIRROR_DIR] + list(args),
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    ).stdout
+
+
+def fetch(max_age=0):
+    '''Update every branch of the mirror from where it was cloned, unless a fetch started up to max_age seconds ago.
+
+    git cannot update the refs of a repository from two fetches at once, so
+    fetches take turns, across threads and processes, and one that started
+    after this was called is used instead of fetching again. Returns
+    whether this fetched.
+    '''
+    asked = time.time()
+    with open(os.path.join(settings.GIT_MIRROR_DIR, 'org-id-fetch.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # The modification time of this file is when the last fetch started
+            fetched_path = os.path.join(settings.GIT_MIRROR_DIR, 'org-id-fetched')
+            try:
+                if os.stat(fetched_path).st_mtime >= asked - max_age:
+                    return False
+            except FileNotFoundError:
+                pass
+            started = time.time()
+            _git('remote', 'update', '--prune')
+            with open(fetched_path, 'a'):
+                os.utime(fetched_path, (started, started))
+            return True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_branch_sha(branch="main"):
+    return _git('rev-parse', '--verify', 'refs/heads/{}^{{commit}}'.format(branch)).decode().strip()
+
+
+def get_commit_time(sha):
+    '''Get when a commit was committed'''
+    timestamp = int(_git('show', '-s', '--format=%ct', sha).decode().strip())
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+
+class BlobReader:
+    '''Reads blobs from the mirror through one git cat-file process, to be used as a context manager.
+
+    Blobs are read one at a time, whichever thread asks for them.
+    '''
+
+    def __enter__(self):
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen(
+            ['git', '--git-dir', settings.GIT_MIRROR_DIR, 'cat-file', '--batch'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self._process.stdin.close()
+        self._process.stdout.close()
+        self._process.wait()
+
+    def read(self, oid):
+        with self._lock:
+            self._process.stdin.write(oid.encode() + b'\n')
+            self._process.stdin.flush()
+            header = self._process.stdout.readline().split()
+            if len(header) != 3 or header[1] != b'blob':
+                raise ValueError('Could not read blob {} from the git mirror: {}'.format(oid, b' '.join(header).decode()))
+            content = self._process.stdout.read(int(header[2]))
+            self._process.stdout.read(1)
+        return content
+
+
+def iter_files(sha, blobs):
+    '''Get (path, oid, read) for every file in commit sha, reading them with the BlobReader blobs.
+
+    As object ids identify the content of files, they can be compared
+    like the CRCs of archive entries, but across branches too.
+    '''
+    listing = _git('ls-tree', '-r', '-z', '--full-tree', sha)
+    for entry in listing.split(b'\0'):
+        if not entry:
+            continue
+        details, path = entry.split(b'\t', 1)
+        mode, kind, oid = details.decode().split()
+        if kind == 'blob':
+            yield path.decode('utf-8'), oid, lambda oid=oid: blobs.read(oid)
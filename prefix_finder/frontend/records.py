@@ -0,0 +1,110 @@
+import sys
+from collections.abc import Mapping
+
+# Strings up to this long are interned, as they are mostly codes and dates
+# repeated across lists; longer ones are names, descriptions and URLs
+INTERN_MAX_LENGTH = 40
+
+
+class ListRecord(Mapping):
+    '''A read-only dict, as an organisation identifier list and the objects in it are kept.
+
+    Values are in a tuple, and the position of each key in a dict that is
+    shared by every record with the same keys, so a record takes little
+    more than its values. It can be used like a dict by templates and
+    other code that only reads it, but is not a dict: use to_plain to get
+    one, e.g. to serialise it.
+    '''
+    __slots__ = ('_positions', '_values')
+
+    def __init__(self, positions, values):
+        self._positions = positions
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._positions[key]]
+
+    def get(self, key, default=None):
+        position = self._positions.get(key)
+        return default if position is None else self._values[position]
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'ListRecord({!r})'.format(dict(self))
+
+    def __reduce__(self):
+        return ListRecord, (self._positions, self._values)
+
+
+# The share key of values that are not shared
+_UNSHARED = object()
+
+
+class Compactor:
+    '''Turns parsed JSON into ListRecords and tuples, sharing what it can.
+
+    Keys and short strings are interned, records with the same keys share
+    their positions, and equal tuples and records that hold only strings,
+    numbers and tuples of them (such as quality_explained) are shared. Use
+    one Compactor for all the lists of a snapshot.
+    '''
+
+    def __init__(self):
+        self._positions = {}
+        self._shared = {}
+
+    def compact(self, value):
+        return self._compact(value)[0]
+
+    def _compact(self, value):
+        '''Get value compacted, and a key only equal for values that are exactly the same.
+
+        Unlike values, keys tell 1, 1.0 and True apart, and -0.0 from 0.0.
+        Shared values are keyed by their id, as each is only made once.
+        '''
+        value_type = type(value)
+        if value_type is str:
+            if len(value) <= INTERN_MAX_LENGTH:
+                value = sys.intern(value)
+            return value, value
+        if value_type is dict:
+            keys = tuple(map(sys.intern, value))
+            positions = self._positions.get(keys)
+            if positions is None:
+                positions = self._positions[keys] = {key: position for position, key in enumerate(keys)}
+            items = [self._compact(item) for item in value.values()]
+            record = ListRecord(positions, tuple([item for item, key in items]))
+            return self._share(record, (keys,) + tuple([key for item, key in items]))
+        if value_type is list:
+            items = [self._compact(item) for item in value]
+            return self._share(tuple([item for item, key in items]), tuple([key for item, key in items]))
+        if value is None:
+            return value, value
+        if value_type is float:
+            return value, (float, repr(value))
+        if value_type is int or value_type is bool:
+            return value, (value_type, value)
+        return value, _UNSHARED
+
+    def _share(self, value, key):
+        if _UNSHARED in key:
+            return value, _UNSHARED
+        shared = self._shared.setdefault(key, value)
+        return shared, id(shared)
+
+
+def to_plain(value):
+    '''Get a ListRecord, or anything in one, back as dicts and lists, as it was parsed'''
+    if isinstance(value, ListRecord):
+        return {key: to_plain(item) for key, item in zip(value._positions, value._values)}
+    if isinstance(value, tuple):
+        return [to_plain(item) for item in value]
+    return value
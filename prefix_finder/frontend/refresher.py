@@ -0,0 +1,79 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Refresher:
+    '''Refreshes branches in background threads, one job per branch at a time.
+
+    refresh is called with a branch name and returns a message describing
+    what it did. Asking for a branch that is already being refreshed joins
+    the job in flight instead of starting another. Once started, a poller
+    also refreshes every branch returned by branches() each interval
+    seconds, plus up to jitter seconds so workers do not poll in step.
+    '''
+
+    def __init__(self, refresh, branches, interval=0, jitter=0):
+        self.refresh = refresh
+        self.branches = branches
+        self.interval = interval
+        self.jitter = jitter
+        self._jobs = {}
+        self._status = {}
+        self._lock = threading.Lock()
+        self._poller = None
+        self._stopped = threading.Event()
+
+    def request(self, branch, wait=False):
+        '''Start refreshing branch unless it already is, and return its status'''
+        with self._lock:
+            job = self._jobs.get(branch)
+            if job is None:
+                job = threading.Thread(target=self._run, args=(branch,), name='refresh-' + branch, daemon=True)
+                self._jobs[branch] = job
+                job.start()
+        if wait:
+            job.join()
+        return self.status(branch)
+
+    def _run(self, branch):
+        started = time.time()
+        result = error = None
+        try:
+            result = self.refresh(branch)
+        except Exception as e:
+            logger.exception('Refreshing branch %s failed', branch)
+            error = repr(e)
+        with self._lock:
+            status = self._status.setdefault(branch, {})
+            status['last_started'] = started
+            status['last_duration'] = round(time.time() - started, 3)
+            status['last_error'] = error
+            if error is None:
+                status['last_result'] = result
+                status['last_success'] = time.time()
+            del self._jobs[branch]
+
+    def status(self, branch):
+        with self._lock:
+            return dict(self._status.get(branch, {}), branch=branch, in_flight=branch in self._jobs)
+
+    def start(self):
+        '''Start polling, if an interval is set and it has not started already'''
+        if not self.interval or self._poller is not None:
+            return
+        with self._lock:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, name='refresh-poller', daemon=True)
+                self._poller.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _poll(self):
+        while not self._stopped.wait(self.interval + random.uniform(0, self.jitter)):
+            for branch in self.branches():
+                self.request(branch)
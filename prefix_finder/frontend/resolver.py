@@ -0,0 +1,35 @@
+class PrefixIndex:
+    '''Finds the organisation list an identifier like GB-COH-01234567 belongs to.
+
+    Codes and formerPrefixes are both indexed, case insensitively, and an
+    identifier matches the longest of them that it starts with, followed
+    by a hyphen or nothing. Codes take precedence over former prefixes.
+    As codes are split on hyphens, this checks at most one dict entry per
+    hyphen in the longest code, however many lists there are.
+    '''
+
+    def __init__(self, org_id_lists):
+        self.prefixes = {}
+        for org_list in org_id_lists:
+            for prefix in org_list.get('formerPrefixes') or ():
+                if prefix:
+                    self.prefixes[prefix.upper()] = (org_list['code'], prefix)
+        for org_list in org_id_lists:
+            self.prefixes[org_list['code'].upper()] = (org_list['code'], None)
+        self.max_parts = max((prefix.count('-') + 1 for prefix in self.prefixes), default=0)
+
+    def resolve(self, identifier):
+        '''Get (code, former_prefix, matched_prefix, local_id) for identifier, or None.
+
+        former_prefix is the formerPrefixes entry matched, or None if the
+        list's current code matched.
+        '''
+        identifier = identifier.strip()
+        parts = identifier.split('-', self.max_parts)
+        for count in range(min(len(parts), self.max_parts), 0, -1):
+            prefix = '-'.join(parts[:count])
+            match = self.prefixes.get(prefix.upper())
+            if match is not None:
+                code, former_prefix = match
+                return code, former_prefix, prefix, identifier[len(prefix) + 1:]
+        return None
@@ -0,0 +1,156 @@
+import numpy as np
+
+# Query keys, the list field each one matches, and whether lists with no
+# value for the field are kept when it is asked for
+QUERY_KEYS = (
+    ('coverage', 'coverage', True),
+    ('structure', 'structure', True),
+    ('sector', 'sector', True),
+    ('subnational', 'subnationalCoverage', False),
+    ('substructure', 'structure', False),
+)
+FIELDS = ('coverage', 'subnationalCoverage', 'structure', 'sector')
+
+# Values of FeatureMatrix.bands
+SUGGESTED, RECOMMENDED, OTHER, FILTERED = 0, 1, 2, 3
+BAND_NAMES = ('suggested', 'recommended', 'other')
+
+
+def smallest_with_ties(keys, limit):
+    '''Get a mask of the limit smallest keys along the last axis, and any tied with the last of them.
+
+    Ties are kept so the caller can break them, such as by position, when
+    it sorts what is left, without sorting everything.
+    '''
+    if limit >= keys.shape[-1]:
+        return np.ones(keys.shape, dtype=bool)
+    if not limit:
+        return np.zeros(keys.shape, dtype=bool)
+    return keys <= np.partition(keys, limit - 1, axis=-1)[..., limit - 1:limit]
+
+
+class FeatureMatrix:
+    '''Organisation lists as NumPy arrays, for scoring many queries at once.
+
+    For each filterable field there is a boolean matrix of codes × lists,
+    with an extra row of False for codes no list uses, and the number of
+    codes each list has. Queries are scored in chunks as queries × lists
+    arrays, following the same rules and RELEVANCE weights as
+    filter_and_score_results.
+    '''
+
+    def __init__(self, org_id_lists, relevance):
+        org_id_lists = list(org_id_lists)
+        self.relevance = relevance
+        self.codes = [org_list['code'] for org_list in org_id_lists]
+        self.quality = np.array([org_list['quality'] for org_list in org_id_lists], dtype=float)
+        self.primary = np.array([org_list.get('listType') == 'primary' for org_list in org_id_lists])
+        self.rows = {}
+        self.members = {}
+        self.counts = {}
+        for field in FIELDS:
+            values = [org_list.get(field) or () for org_list in org_id_lists]
+            rows = {}
+            for codes in values:
+                for code in codes:
+                    rows.setdefault(code, len(rows))
+            members = np.zeros((len(rows) + 1, len(org_id_lists)), dtype=bool)
+            for position, codes in enumerate(values):
+                members[[rows[code] for code in codes], position] = True
+            self.rows[field] = rows
+            self.members[field] = members
+            self.counts[field] = np.array([len(codes) for codes in values])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _matches(self, field, values):
+        '''Rows of members for a code from each query, False for no code'''
+        rows = self.rows[field]
+        missing = len(rows)
+        return self.members[field][[rows.get(value, missing) if value else missing for value in values]]
+
+    def score(self, queries):
+        '''Get which lists each query keeps, their relevance, and which relevances are floats.
+
+        Returns three queries × lists arrays. filter_and_score_results
+        gives a float relevance when it adds half of MATCH_DROPDOWN, which
+        the third one records, so callers can give the same type back.
+        '''
+        weights = self.relevance
+        dropdown = weights['MATCH_DROPDOWN']
+        only_value = weights['MATCH_DROPDOWN_ONLY_VALUE']
+        empty = weights['MATCH_EMPTY']
+        asked = {key: np.array([bool(query.get(key)) for query in queries])[:, None] for key, field, keep_empty in QUERY_KEYS}
+        counts = self.counts
+
+        keep = np.ones((len(queries), len(self)), dtype=bool)
+        for key, field, keep_empty in QUERY_KEYS:
+            matches = self._matches(field, [query.get(key) for query in queries])
+            if keep_empty:
+                matches |= counts[field] == 0
+            keep &= ~asked[key] | matches
+
+        relevance = np.zeros(keep.shape)
+        relevance += np.where(self.primary, dropdown, 0)
+
+        has_coverage = counts['coverage'] > 0
+        is_float = asked['coverage'] & has_coverage & ~asked['subnational'] & (counts['subnationalCoverage'] == 0)
+        relevance += np.where(asked['coverage'] & has_coverage, dropdown + np.where(counts['coverage'] == 1, only_value, 0), 0)
+        relevance += np.where(is_float, dropdown / 2, 0)
+        relevance += np.where(~asked['coverage'] & ~has_coverage, empty, 0)
+
+        relevance += np.where(asked['subnational'], dropdown * 2 + np.where(counts['subnationalCoverage'] == 1, only_value, 0), 0)
+
+        has_structure = counts['structure'] > 0
+        relevance += np.where(asked['structure'] & has_structure, dropdown + np.where(counts['structure'] == 1, only_value, 0), 0)
+        relevance += np.where(~asked['structure'] & ~has_structure, empty, 0)
+        relevance += np.where(asked['substructure'], dropdown * 2, 0)
+
+        has_sector = counts['sector'] > 0
+        relevance += np.where(asked['sector'] & has_sector, dropdown * 2 + np.where(counts['sector'] == 1, only_value * 2, 0), 0)
+        relevance += np.where(~asked['sector'] & ~has_sector, empty, 0)
+
+        return keep, relevance, is_float
+
+    def bands(self, keep, relevance):
+        '''Get the band of each list for each query, FILTERED if the query does not keep it.
+
+        Lists are ranked by relevance * 100 + quality, ties going to the
+        earlier list. The best ranked list over both suggested thresholds
+        is suggested, along with every list with the same relevance.
+        '''
+        weights = self.relevance
+        rank_key = relevance * 100 + self.quality
+        eligible = keep & (relevance >= weights['SUGGESTED_RELEVANCE_THRESHOLD']) & (self.quality > weights['SUGGESTED_QUALITY_THRESHOLD'])
+        has_suggested = eligible.any(axis=1)
+        best = np.where(eligible, rank_key, -np.inf).argmax(axis=1)
+        suggested_relevance = relevance[np.arange(len(relevance)), best][:, None]
+
+        bands = np.where(relevance >= weights['RECOMMENDED_RELEVANCE_THRESHOLD'], RECOMMENDED, OTHER)
+        bands[has_suggested[:, None] & (relevance == suggested_relevance)] = SUGGESTED
+        bands[~keep] = FILTERED
+        return bands
+
+    def ranked(self, bands, relevance, limit=None):
+        '''Get the positions of kept lists for each query, in the order they are shown.
+
+        That is suggested, then recommended, then other, and by rank
+        within each band. If limit is given only the first limit are found,
+        without sorting the rest.
+        '''
+        rank_key = relevance * 100 + self.quality
+        # Puts each band after the one before, whatever the rank keys
+        band_gap = np.abs(rank_key).max() * 2 + 1 if rank_key.size else 1
+        order_key = np.where(bands == FILTERED, np.inf, bands * band_gap - rank_key)
+
+        candidates = bands != FILTERED
+        if limit is not None:
+            # The earlier lists win ties with the last one below
+            candidates &= smallest_with_ties(order_key, limit)
+
+        rows, positions = np.nonzero(candidates)
+        order = np.lexsort((positions, order_key[rows, positions], rows))
+        rows, positions = rows[order], positions[order]
+        starts = np.searchsorted(rows, np.arange(len(order_key) + 1))
+        return [positions[start:end][:limit].tolist() for start, end in zip(starts[:-1], starts[1:])]
@@ -0,0 +1,169 @@
+import bisect
+import math
+import re
+import unicodedata
+from collections.abc import Mapping
+
+import numpy as np
+
+from .scoring import smallest_with_ties
+
+# Fields searched, and how much a word in each counts towards the score
+SEARCH_FIELDS = (
+    (('name', 'en'), 3),
+    (('name', 'local'), 2),
+    (('description', 'en'), 1),
+    (('code', ), 3),
+    (('formerPrefixes', ), 2),
+)
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Score added for a list with a quality of 100, so better lists win close matches
+QUALITY_WEIGHT = 1.0
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(text):
+    '''Lower case words of text, without accents, so Registro matches registro and Société matches societe'''
+    text = text.casefold()
+    if not text.isascii():
+        text = ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+    return _WORD.findall(text)
+
+
+def _field_values(org_list, path):
+    value = org_list
+    for key in path:
+        value = value.get(key) if isinstance(value, Mapping) else None
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [item for item in value if isinstance(item, str)]
+    return []
+
+
+class SearchIndex:
+    '''Finds organisation lists by words in their names, descriptions, codes and former prefixes.
+
+    Each word maps to the lists it is in and the BM25 score it gives each
+    of them, worked out when the index is built, with words weighted by
+    SEARCH_FIELDS. A search adds up the scores of its words for the lists
+    that have all of them, plus QUALITY_WEIGHT for each 100 of quality.
+    The last word of a search also matches longer words starting with it,
+    for autocomplete, found with a binary search of the sorted words, and
+    the best scores for each prefix of up to PREFIX_LENGTH letters are
+    kept, as those match the most words.
+
+    Given the indexes of previous snapshots, the words of lists they share
+    with this one (as the same objects) are not counted again.
+    '''
+
+    PREFIX_LENGTH = 2
+
+    def __init__(self, org_id_lists, previous=()):
+        org_id_lists = list(org_id_lists)
+        self.codes = [org_list['code'] for org_list in org_id_lists]
+        self.quality = np.array([org_list.get('quality') or 0 for org_list in org_id_lists], dtype=float) * QUALITY_WEIGHT / 100
+
+        previous_counts = {id(org_list): counts for index in previous for org_list, counts in index._word_counts.values()}
+        # The weighted count of each word in each list, by code, with the list it was counted for
+        self._word_counts = {}
+        frequencies = []
+        lengths = []
+        for org_list in org_id_lists:
+            counts = previous_counts.get(id(org_list))
+            if counts is None:
+                counts = {}
+                for path, weight in SEARCH_FIELDS:
+                    for value in _field_values(org_list, path):
+                        for word in tokenize(value):
+                            counts[word] = counts.get(word, 0) + weight
+            self._word_counts[org_list['code']] = (org_list, counts)
+            frequencies.append(counts)
+            lengths.append(sum(counts.values()))
+        average_length = sum(lengths) / len(lengths) if lengths else 0
+
+        postings = {}
+        for position, counts in enumerate(frequencies):
+            for word, frequency in counts.items():
+                postings.setdefault(word, ([], []))
+                postings[word][0].append(position)
+                postings[word][1].append(frequency)
+
+        lengths = np.array(lengths, dtype=float)
+        # The BM25 score of each word, for each list it is in
+        self.postings = {}
+        for word, (positions, frequency) in postings.items():
+            positions = np.array(positions, dtype=np.int32)
+            frequency = np.array(frequency, dtype=float)
+            idf = math.log(1 + (len(org_id_lists) - len(positions) + 0.5) / (len(positions) + 0.5))
+            scores = idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * lengths[positions] / average_length))
+            self.postings[word] = (positions, scores)
+        self.words = sorted(self.postings)
+
+        self.prefixes = {}
+        for length in range(1, self.PREFIX_LENGTH + 1):
+            for prefix in {word[:length] for word in self.words if len(word) > length}:
+                self.prefixes[prefix] = self._merge_prefix(prefix)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getstate__(self):
+        # Word counts are only kept to build the next index quickly, so are not saved
+        return dict(self.__dict__, _word_counts={})
+
+    def _merge_prefix(self, prefix):
+        '''Lists with words starting with prefix, and the best score of those words for each'''
+        start = bisect.bisect_left(self.words, prefix)
+        end = bisect.bisect_left(self.words, prefix + '\U0010ffff', start)
+        if end - start == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0)
+        if end - start == 1:
+            return self.postings[self.words[start]]
+        postings = [self.postings[word] for word in self.words[start:end]]
+        positions = np.concatenate([positions for positions, scores in postings])
+        scores = np.concatenate([scores for positions, scores in postings])
+        # The best score for each list comes first, so is the one kept by unique
+        order = np.lexsort((-scores, positions))
+        positions, first = np.unique(positions[order], return_index=True)
+        return positions, scores[order][first]
+
+    def _prefix_postings(self, prefix):
+        merged = self.prefixes.get(prefix)
+        if merged is None:
+            merged = self._merge_prefix(prefix)
+        return merged
+
+    def search(self, text, limit=None, prefix=True):
+        '''Get (code, score) for the lists matching every word of text, best first.
+
+        If prefix is true and text does not end with a space, its last word
+        also matches words it is the start of.
+        '''
+        words = tokenize(text)
+        if not words:
+            return []
+        last = None
+        if prefix and not text[-1].isspace():
+            last = words.pop()
+        empty = (np.zeros(0, dtype=np.int32), np.zeros(0))
+        word_postings = [self.postings.get(word, empty) for word in dict.fromkeys(words)]
+        if last is not None:
+            word_postings.append(self._prefix_postings(last))
+
+        totals = self.quality.copy()
+        matched = np.zeros(len(self), dtype=np.int32)
+        for positions, scores in word_postings:
+            totals[positions] += scores
+            matched[positions] += 1
+        found = np.flatnonzero(matched == len(word_postings))
+        if limit is not None:
+            # The earlier lists win ties with the last one below
+            found = found[smallest_with_ties(-totals[found], limit)]
+        # Best first, ties going to the earlier list
+        found = found[np.lexsort((found, -totals[found]))][:limit]
+        codes = self.codes
+        return [(codes[position], score) for position, score in zip(found.tolist(), totals[found].tolist())]
@@ -0,0 +1,104 @@
+import contextlib
+import fcntl
+import os
+import pickle
+import stat
+import tempfile
+import time
+
+
+class SharedSnapshotFiles:
+    '''Snapshots saved to a directory so that every worker can use them.
+
+    Each branch has a pickle file, replaced atomically whenever a worker
+    loads a new commit, and a lock file held while a worker refreshes it.
+    Files are only read back if they were written with the same format, so
+    changing what a snapshot holds just needs format to be bumped. As files
+    are unpickled, nothing is read from or written to a directory (or file)
+    that belongs to another user or that other users can write to.
+    '''
+
+    def __init__(self, directory, format):
+        self.directory = directory
+        self.format = format
+        self._seen = {}
+
+    def path(self, branch, extension='pickle'):
+        return os.path.join(self.directory, '{}.{}'.format(branch, extension))
+
+    def _is_trusted(self, path):
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return stat_result.st_uid == os.getuid() and not stat_result.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    def _check_directory(self):
+        '''Create the directory, only usable by us, or check that an existing one could only have been written by us'''
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        if not self._is_trusted(self.directory):
+            raise PermissionError(
+                'Shared snapshot directory {} must belong to this user and not be writable by others'.format(self.directory)
+            )
+
+    def _signature(self, branch):
+        try:
+            stat = os.stat(self.path(branch))
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def save(self, branch, snapshot):
+        self._check_directory()
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=branch + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                pickle.dump({'format': self.format, 'sha': snapshot.sha, 'snapshot': snapshot}, temp_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.path(branch))
+        except Exception:
+            os.unlink(temp_path)
+            raise
+        # Our own write does not need reading back
+        self._seen[branch] = self._signature(branch)
+
+    def load_if_changed(self, branch):
+        '''Get the saved snapshot for branch if the file changed since last seen, otherwise None'''
+        signature = self._signature(branch)
+        if signature is None or signature == self._seen.get(branch):
+            return None
+        self._seen[branch] = signature
+        if not self._is_trusted(self.directory) or not self._is_trusted(self.path(branch)):
+            return None
+        try:
+            with open(self.path(branch), 'rb') as snapshot_file:
+                saved = pickle.load(snapshot_file)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        if saved.get('format') != self.format:
+            return None
+        return saved['snapshot']
+
+    def mark_checked(self, branch):
+        '''Record that some worker just checked which commit branch is on'''
+        self._check_directory()
+        with open(self.path(branch, 'checked'), 'a'):
+            os.utime(self.path(branch, 'checked'))
+
+    def checked_within(self, branch, seconds):
+        '''Whether any worker checked which commit branch is on in the last seconds'''
+        try:
+            checked = os.stat(self.path(branch, 'checked')).st_mtime
+        except FileNotFoundError:
+            return False
+        return time.time() - checked < seconds
+
+    @contextlib.contextmanager
+    def lock(self, branch):
+        '''Hold the refresh lock for branch, waiting for any other worker to finish'''
+        self._check_directory()
+        with open(self.path(branch, 'lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,172 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_size(obj, seen=None):
+    '''Estimate the memory used by obj and everything it references, in bytes.
+
+    Objects referenced more than once are only counted once. Objects whose
+    ids are in seen are skipped, and the ids of those counted are added to
+    it, so several calls can share it to count each object once overall.
+    '''
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        elif hasattr(obj, '__slots__'):
+            stack.extend(getattr(obj, slot) for slot in obj.__slots__ if hasattr(obj, slot))
+    return size
+
+
+class SnapshotStore:
+    '''The published snapshot of each loaded branch.
+
+    Pinned branches are always kept. Other branches are evicted when they
+    have not been used for idle_ttl seconds, and least recently used first
+    while there are more than max_branches or the snapshots take up more
+    than memory_budget bytes, though never the branch used most recently.
+    Zero turns a limit off. on_evict is called with the name of each
+    evicted branch.
+
+    Branches only count as used when they are got, so a branch that is
+    republished but never looked at still goes once it is idle.
+
+    Snapshots can say which of the objects they hold may be held by other
+    snapshots too (like lists reused when a branch is reloaded). The size
+    of each of those is only estimated the first time it is published, and
+    it is counted once however many snapshots hold it.
+    '''
+
+    def __init__(self, pinned=('main',), max_branches=0, idle_ttl=0, memory_budget=0, on_evict=None):
+        self.pinned = set(pinned)
+        self.max_branches = max_branches
+        self.idle_ttl = idle_ttl
+        self.memory_budget = memory_budget
+        self.on_evict = on_evict
+        self._entries = OrderedDict()
+        # For each shared object, by id: the object, its size and the branches holding it
+        self._shared = {}
+        self._lock = threading.Lock()
+
+    def get(self, branch):
+        with self._lock:
+            entry = self._entries.get(branch)
+            if entry is not None:
+                entry['last_used'] = time.time()
+                self._entries.move_to_end(branch)
+        self.evict()
+        return entry['snapshot'] if entry else None
+
+    def peek(self, branch):
+        '''Get the snapshot for branch without counting it as used'''
+        entry = self._entries.get(branch)
+        return entry['snapshot'] if entry else None
+
+    def publish(self, branch, snapshot, shared=()):
+        '''Make snapshot the one served for branch, replacing any previous one.
+
+        shared are the objects of snapshot that other snapshots may hold too.
+        '''
+        shared = {id(obj): obj for obj in shared}
+        with self._lock:
+            new = [obj for key, obj in shared.items() if key not in self._shared]
+        # Sized together, so what new objects share between them is counted
+        # once, and without the shared objects they hold
+        seen = shared.keys() - {id(obj) for obj in new}
+        sizes = {id(obj): estimate_size(obj, seen) for obj in new}
+        size = estimate_size(snapshot, seen)
+        with self._lock:
+            for key, obj in shared.items():
+                if key not in self._shared:
+                    self._shared[key] = {'object': obj, 'size': sizes.get(key) or estimate_size(obj), 'branches': set()}
+                self._shared[key]['branches'].add(branch)
+            previous = self._entries.get(branch)
+            if previous is None:
+                self._entries[branch] = {'last_used': time.time()}
+            else:
+                self._release(branch, previous['shared'].keys() - shared.keys())
+            self._entries[branch].update(snapshot=snapshot, size=size, shared=shared)
+        self.evict()
+
+    def _release(self, branch, keys):
+        for key in keys:
+            branches = self._shared[key]['branches']
+            branches.discard(branch)
+            if not branches:
+                del self._shared[key]
+
+    def evict(self):
+        evicted = []
+        with self._lock:
+            now = time.time()
+            unpinned = [branch for branch in self._entries if branch not in self.pinned]
+            for branch in unpinned:
+                if self.idle_ttl and now - self._entries[branch]['last_used'] > self.idle_ttl:
+                    evicted.append(branch)
+            most_recent = next(reversed(self._entries), None)
+            for branch in unpinned:
+                if branch in evicted or branch == most_recent:
+                    continue
+                over_count = self.max_branches and len(self._entries) - len(evicted) > self.max_branches
+                over_budget = self.memory_budget and self._total_size(evicted) > self.memory_budget
+                if not over_count and not over_budget:
+                    break
+                evicted.append(branch)
+            for branch in evicted:
+                self._release(branch, self._entries.pop(branch)['shared'])
+        for branch in evicted:
+            if self.on_evict:
+                self.on_evict(branch)
+        return evicted
+
+    def _total_size(self, excluding=()):
+        kept = [branch for branch in self._entries if branch not in excluding]
+        shared = {key for branch in kept for key in self._entries[branch]['shared']}
+        return sum(self._own_size(self._entries[branch]) for branch in kept) + sum(self._shared[key]['size'] for key in shared)
+
+    def _own_size(self, entry):
+        # Downloads are added to snapshots after they are published
+        return entry['size'] + sum(
+            len(artifact.content) + len(artifact.gzip_content) for artifact in entry['snapshot'].artifacts.values()
+        )
+
+    def _entry_size(self, entry):
+        # Shared objects are split between the branches holding them
+        return self._own_size(entry) + sum(
+            self._shared[key]['size'] // len(self._shared[key]['branches']) for key in entry['shared']
+        )
+
+    def branches(self):
+        return list(self._entries)
+
+    def __contains__(self, branch):
+        return branch in self._entries
+
+    def report(self):
+        '''Describe each loaded branch, including an estimate of the memory it uses'''
+        with self._lock:
+            return [
+                {
+                    'branch': branch,
+                    'sha': entry['snapshot'].sha,
+                    'pinned': branch in self.pinned,
+                    'memory_bytes': self._entry_size(entry),
+                    'idle_seconds': round(time.time() - entry['last_used'], 1),
+                }
+                for branch, entry in self._entries.items()
+            ]
@@ -1,6 +1,9 @@
 from collections import OrderedDict
+from collections.abc import Mapping
 from django import template
 
+from ..timing import span
+
 register = template.Library()
 
 paths_display_name = OrderedDict((
@@ -38,6 +41,7 @@ paths_display_name_long = OrderedDict((
 
 
 @register.filter(name='tidy_results')
+@span('tidy_results')
 def tidy_results(results, length=None):
     paths_display = OrderedDict(paths_display_name)
     if length == 'long':
@@ -52,9 +56,9 @@ def tidy_results(results, length=None):
         if not info:
             continue
 
-        if isinstance(info, list):
+        if isinstance(info, (list, tuple)):
             tidied_results[key_name] = ", ".join(info).replace('_', ' ')
-        elif isinstance(info, dict):
+        elif isinstance(info, Mapping):
             if 'en' in info:
                 info = info['en']
                 if info:
@@ -66,7 +70,7 @@ def tidy_results(results, length=None):
                     tidied_results[key_name] = '{}.'.format(info)
             else:
                 for field_name, details in info.items():
-                    if isinstance(details, list):
+                    if isinstance(details, (list, tuple)):
                         details = ", ".join(details).join(info).replace('_', ' ')
                     tidied_results[field_name] = details
         else:
@@ -1,19 +1,1254 @@
-from .views import make_xml_codelist
-import requests
+from .views import make_xml_codelist, read_register, iter_archive_files, get_snapshot, RegisterSnapshot, filter_and_score_results, get_lookups, RELEVANCE
+from .cache import QueryCache
+from .store import SnapshotStore
+from .refresher import Refresher
+from .shared import SharedSnapshotFiles
+from .resolver import PrefixIndex
+from .search import SearchIndex, tokenize
+from . import ingest
+from .records import Compactor, ListRecord, to_plain
+from .templatetags.results import tidy_results
+from . import store
+from . import github
+from . import mirror
+from . import views
+from . import timing
 import io
+import datetime
+import pytest
+import gzip
+import json
+import pickle
+import zipfile
 from lxml import etree
 import os
+import threading
+import time
+import itertools
+import random
+import subprocess
+from django.http import HttpResponse
+from django.test import Client, RequestFactory
 
 
 
+def make_schemas():
+    def codelist(*codes, **extra):
+        return [dict({'code': code, 'title': {'en': code.upper()}}, **extra) for code in codes]
+
+    return {
+        'codelist-coverage': {
+            'coverage': codelist('GB', 'FR'),
+            'subnationalCoverage': codelist('GB-SCT', 'GB-WLS', countryCode='GB'),
+        },
+        'codelist-structure': {'structure': [
+            {'code': 'company', 'title': {'en': 'Company'}, 'parent': ''},
+            {'code': 'charity', 'title': {'en': 'Charity'}, 'parent': ''},
+            {'code': 'company/limited', 'title': {'en': 'Company > Limited'}, 'parent': 'company'},
+        ]},
+        'codelist-sector': {'sector': codelist('health', 'education')},
+        'codelist-availability': {'availability': codelist('api', quality_score=10)},
+        'codelist-licenseStatus': {'licenseStatus': codelist('open_license', quality_score=30)},
+        'codelist-listType': {'listType': codelist('primary', 'secondary', quality_score=20)},
+    }
+
+
+def make_org_id_lists():
+    def org_id_list(code, **fields):
+        return dict({
+            'code': code,
+            'name': {'en': code + ' register'},
+            'description': {'en': 'Lists in ' + code},
+            'url': 'http://example.com/' + code,
+            'confirmed': True,
+            'data': {'availability': ['api'], 'licenseStatus': 'open_license'},
+        }, **fields)
+
+    return [
+        org_id_list('GB-COH', coverage=['GB'], structure=['company/limited'], listType='primary'),
+        org_id_list('GB-SC', coverage=['GB'], subnationalCoverage=['GB-SCT'], structure=['charity'], listType='primary'),
+        org_id_list('GB-NHS', coverage=['GB'], sector=['health'], listType='secondary'),
+        org_id_list('FR-RCS', coverage=['FR'], structure=['company'], listType='primary'),
+        org_id_list('XI-ANY', listType='secondary'),
+        org_id_list('XX-DRAFT', coverage=['GB'], confirmed=False),
+    ]
+
+
+def make_snapshot(branch='test'):
+    changed_at = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    return RegisterSnapshot(branch, make_schemas(), make_org_id_lists(), sha='abc123', changed_at=changed_at)
+
+
+def publish_main(monkeypatch):
+    '''Serve make_snapshot() as main, without loading anything'''
+    monkeypatch.setattr(views, 'snapshots', SnapshotStore())
+    monkeypatch.setattr(views, 'shared_snapshots', None)
+    monkeypatch.setattr(views, 'refresher', Refresher(lambda branch: None, list))
+    monkeypatch.setattr(views, 'query_cache', QueryCache())
+    views.snapshots.publish('main', make_snapshot('main'))
+
+
+def get(view, path, params=None):
+    request = RequestFactory().get(path, params)
+    request.session = {}
+    return view(request)
+
+
 def test_xml_codelists():
     schema = open(os.path.dirname(os.path.realpath(__file__)) + "/codelist.xsd").read()
     schema_file = io.StringIO(schema)
     schema_file_parsed = etree.parse(schema_file)
 
     xmlschema = etree.XMLSchema(schema_file_parsed)
-    created_xml_codelist = make_xml_codelist('main')
+    created_xml_codelist = make_xml_codelist(get_snapshot('main'))
     created_xml_codelist_file = io.StringIO(created_xml_codelist)
     xml_codelist_etree = etree.parse(created_xml_codelist_file)
 
     xmlschema.assertValid(xml_codelist_etree)
+
+
+def test_query_cache():
+    cache = QueryCache(maxsize=2)
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        return value
+
+    assert cache.get_or_set(('main', 'sha1', 'a'), lambda: compute(1)) == 1
+    assert cache.get_or_set(('main', 'sha1', 'a'), lambda: compute(2)) == 1
+    cache.get_or_set(('preview', 'sha2', 'b'), lambda: compute(3))
+    cache.get_or_set(('main', 'sha1', 'c'), lambda: compute(4))
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'size': 2, 'maxsize': 2}
+
+    # ('main', 'sha1', 'a') was the least recently used, so was evicted
+    assert cache.get_or_set(('main', 'sha1', 'a'), lambda: compute(5)) == 5
+
+    cache.invalidate('main')
+    assert cache.stats()['size'] == 0
+    assert calls == [1, 3, 4, 5]
+
+
+def test_fetch_archive(httpserver, settings):
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w') as archive:
+        archive.writestr('register-main/schema/codelist-sector.json', json.dumps({'sector': []}))
+        archive.writestr('register-main/lists/gb/gb-coh.json', json.dumps({'code': 'GB-COH'}))
+        archive.writestr('register-main/lists/README.md', 'Not a list')
+    settings.GITHUB_ARCHIVE_URL = httpserver.url + '/{branch}.zip'
+
+    httpserver.serve_content(content.getvalue(), headers={'ETag': '"abc"'})
+    archive, etag = github.fetch_archive('main')
+    with archive, zipfile.ZipFile(archive) as ziped_repo:
+        schemas, org_id_lists, sources = read_register(iter_archive_files(ziped_repo))
+    assert etag == '"abc"'
+    assert schemas == {'codelist-sector': {'sector': []}}
+    assert org_id_lists == [{'code': 'GB-COH'}]
+    assert httpserver.requests[-1].path == '/main.zip'
+
+    # An unchanged archive is not downloaded again
+    httpserver.serve_content('', code=304)
+    assert github.fetch_archive('main', etag) == (None, '"abc"')
+    assert httpserver.requests[-1].headers['If-None-Match'] == '"abc"'
+
+
+def test_get_branch_commit(httpserver, settings):
+    settings.GITHUB_BRANCH_API_URL = httpserver.url + '/branches/{branch}'
+    httpserver.serve_content(json.dumps({'commit': {'sha': 'abc123', 'commit': {'committer': {'date': '2020-01-02T03:04:05Z'}}}}))
+    assert github.get_branch_commit('main') == ('abc123', datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc))
+    assert httpserver.requests[-1].path == '/branches/main'
+
+
+def make_archive(schemas, org_id_lists):
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, 'w') as archive:
+        for name, schema in schemas.items():
+            archive.writestr('register-main/schema/{}.json'.format(name), json.dumps(schema))
+        for org_id_list in org_id_lists:
+            archive.writestr('register-main/lists/{}/{}.json'.format(org_id_list['code'][:2].lower(), org_id_list['code'].lower()), json.dumps(org_id_list))
+    return zipfile.ZipFile(content)
+
+
+def test_incremental_reload():
+    def load(schemas, org_id_lists, *previous):
+        files = read_register(iter_archive_files(make_archive(schemas, org_id_lists)), previous)
+        return RegisterSnapshot('test', *files[:2], sources=files[2], previous=previous)
+
+    schemas, org_id_lists = make_schemas(), make_org_id_lists()
+    first = load(schemas, org_id_lists)
+    assert first.parsed_lists == len(org_id_lists)
+
+    org_id_lists[2]['name'] = {'en': 'Renamed register'}
+    org_id_lists.append(dict(org_id_lists[0], code='GB-NEW'))
+    del org_id_lists[3]
+    second = load(schemas, org_id_lists, first)
+    assert second.parsed_lists == 2
+    assert second.lists['GB-COH'] is first.lists['GB-COH']
+    assert second.columns['GB-COH'] is first.columns['GB-COH']
+    assert second.lists['GB-NHS']['name'] == {'en': 'Renamed register'}
+    assert 'FR-RCS' not in second.lists
+    # The same as loading everything again
+    full = load(schemas, org_id_lists)
+    assert second.lists == full.lists
+    assert second.titles == full.titles
+    assert second.csv_headers == full.csv_headers
+    assert second.search.search('register') == full.search.search('register')
+    assert [code for code, score in second.search.search('renamed')] == ['GB-NHS']
+    results, expected = filter_and_score_results({'coverage': 'GB'}, second), filter_and_score_results({'coverage': 'GB'}, full)
+    assert {band: [repr(result) for result in results[band]] for band in results} == \
+        {band: [repr(result) for result in expected[band]] for band in expected}
+
+    # Any change to the schemas loads everything again
+    schemas['codelist-listType']['listType'][0]['quality_score'] = 50
+    third = load(schemas, org_id_lists, second)
+    assert third.parsed_lists == len(org_id_lists)
+    assert third.lists['GB-COH']['quality'] == full.lists['GB-COH']['quality'] + 30
+
+
+def test_reload_without_changes(tmp_path, monkeypatch, settings):
+    write_register(tmp_path, make_schemas(), make_org_id_lists())
+    settings.LOCAL_DATA = True
+    settings.LOCAL_DATA_DIR = str(tmp_path)
+    monkeypatch.setattr(views, 'snapshots', SnapshotStore())
+    monkeypatch.setattr(views, 'shared_snapshots', None)
+
+    assert views.refresh_data('main') == 'Loaded from disk'
+    snapshot = views.snapshots.peek('main')
+    assert snapshot.changed_at.timestamp() == pytest.approx(max(path.stat().st_mtime for path in tmp_path.glob('*/**/*.json')))
+    assert views.refresh_data('main') == 'Not updating as no files have changed'
+    assert views.snapshots.peek('main') is snapshot
+
+
+def test_query_cache_follows_reloads_from_disk(tmp_path, monkeypatch, settings):
+    org_id_lists = make_org_id_lists()
+    write_register(tmp_path, make_schemas(), org_id_lists)
+    settings.LOCAL_DATA = True
+    settings.LOCAL_DATA_DIR = str(tmp_path)
+    monkeypatch.setattr(views, 'snapshots', SnapshotStore())
+    monkeypatch.setattr(views, 'shared_snapshots', None)
+    # Shared between workers, so not emptied when a branch is reloaded
+    monkeypatch.setattr(views, 'query_cache', QueryCache(maxsize=0, backend='default'))
+
+    def suggested():
+        results = views.cached_query(filter_and_score_results, {'coverage': 'FR'}, views.snapshots.peek('main'))
+        return [result['code'] for result in results['suggested']]
+
+    views.refresh_data('main')
+    assert suggested() == ['FR-RCS']
+    org_id_lists[3]['listType'] = 'secondary'
+    write_register(tmp_path, {}, org_id_lists[3:4])
+    views.refresh_data('main')
+    assert suggested() == []
+
+
+def git(cwd, *args):
+    return subprocess.run(
+        ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com'] + list(args),
+        cwd=cwd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    ).stdout.decode().strip()
+
+
+def write_register(directory, schemas, org_id_lists):
+    for name, schema in schemas.items():
+        path = directory / 'schema' / (name + '.json')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(schema))
+    for org_id_list in org_id_lists:
+        path = directory / 'lists' / org_id_list['code'][:2].lower() / (org_id_list['code'].lower() + '.json')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(org_id_list))
+
+
+def make_mirror(tmp_path):
+    '''Make a register with a main branch and a preview branch that changes one list, and a mirror of it'''
+    work = tmp_path / 'register'
+    work.mkdir()
+    git(work, 'init', '-q')
+    git(work, 'symbolic-ref', 'HEAD', 'refs/heads/main')
+    org_id_lists = make_org_id_lists()
+    write_register(work, make_schemas(), org_id_lists)
+    git(work, 'add', '.')
+    git(work, 'commit', '-q', '-m', 'Register')
+    git(work, 'checkout', '-q', '-b', 'preview')
+    org_id_lists[2]['name'] = {'en': 'Renamed register'}
+    write_register(work, {}, org_id_lists)
+    git(work, 'commit', '-q', '-a', '-m', 'Rename')
+    git(work, 'checkout', '-q', 'main')
+    git(tmp_path, 'clone', '-q', '--mirror', str(work), 'mirror.git')
+    return work, org_id_lists
+
+
+def store_size():
+    '''The memory used by every loaded branch, as accounted by the store'''
+    return sum(entry['memory_bytes'] for entry in views.snapshots.report())
+
+
+def test_git_mirror(tmp_path, monkeypatch, settings):
+    work, org_id_lists = make_mirror(tmp_path)
+    settings.LOCAL_DATA = False
+    settings.GIT_MIRROR_DIR = str(tmp_path / 'mirror.git')
+    settings.GIT_MIRROR_FETCH = False
+    monkeypatch.setattr(views, 'snapshots', SnapshotStore())
+    monkeypatch.setattr(views, 'shared_snapshots', None)
+
+    sha = git(work, 'rev-parse', 'main')
+    assert views.refresh_data('main') == 'Loaded from git mirror: {}'.format(sha)
+    main = views.snapshots.peek('main')
+    assert main.parsed_lists == len(org_id_lists)
+    assert main.changed_at.timestamp() == int(git(work, 'show', '-s', '--format=%ct', 'main'))
+    assert views.refresh_data('main') == 'Not updating as sha has not changed: {}'.format(sha)
+
+    # Unchanged lists are shared with main, not parsed again
+    main_size = store_size()
+    views.refresh_data('preview')
+    preview = views.snapshots.peek('preview')
+    assert preview.sha == git(work, 'rev-parse', 'preview')
+    assert preview.parsed_lists == 1
+    assert preview.lists['GB-NHS']['name'] == {'en': 'Renamed register'}
+    assert main.lists['GB-NHS']['name'] == {'en': 'GB-NHS register'}
+    for code in ('GB-COH', 'GB-SC', 'FR-RCS', 'XI-ANY'):
+        assert preview.lists[code] is main.lists[code]
+        assert preview.titles[code] is main.titles[code]
+    assert preview.lookups is main.lookups
+    # Which only leaves the indexes of every list to add
+    preview_size = store_size() - main_size
+    assert preview_size < main_size * 0.6
+
+    # A branch with the same files as another shares everything with it
+    git(work, 'checkout', '-q', '-b', 'copy')
+    git(work, 'commit', '-q', '--allow-empty', '-m', 'Nothing changed')
+    git(work, 'checkout', '-q', 'main')
+    git(tmp_path / 'mirror.git', 'fetch', '-q', str(work), 'copy:copy')
+    views.refresh_data('copy')
+    copy = views.snapshots.peek('copy')
+    assert copy.sha == git(work, 'rev-parse', 'copy')
+    assert copy.parsed_lists == 0
+    assert copy.search is main.search and copy.index is main.index
+    assert store_size() - main_size - preview_size < main_size * 0.1
+
+    # New commits are fetched into the mirror when asked
+    org_id_lists[3]['name'] = {'en': 'Updated register'}
+    write_register(work, {}, org_id_lists[3:4])
+    git(work, 'commit', '-q', '-a', '-m', 'Update')
+    views.refresh_data('main')
+    assert views.snapshots.peek('main').sha == sha
+    settings.GIT_MIRROR_FETCH = True
+    views.refresh_data('main')
+    main = views.snapshots.peek('main')
+    assert main.sha == git(work, 'rev-parse', 'main')
+    assert main.parsed_lists == 1
+    assert main.lists['FR-RCS']['name'] == {'en': 'Updated register'}
+
+    with pytest.raises(subprocess.CalledProcessError):
+        views.refresh_data('missing')
+
+
+def test_git_mirror_fetches_once_for_branches_refreshed_together(tmp_path, monkeypatch, settings):
+    work, org_id_lists = make_mirror(tmp_path)
+    settings.LOCAL_DATA = False
+    settings.GIT_MIRROR_DIR = str(tmp_path / 'mirror.git')
+    settings.GIT_MIRROR_FETCH = True
+    settings.REFRESH_INTERVAL = 300
+    monkeypatch.setattr(views, 'snapshots', SnapshotStore())
+    monkeypatch.setattr(views, 'shared_snapshots', None)
+    fetches = []
+    git_command = mirror._git
+
+    def counting_git(*args):
+        if args[0] == 'remote':
+            fetches.append(args)
+            time.sleep(0.2)
+        return git_command(*args)
+
+    monkeypatch.setattr(mirror, '_git', counting_git)
+    refresher = Refresher(views.refresh_data, list)
+    refresher.request('main')
+    refresher.request('preview')
+    statuses = [refresher.request(branch, wait=True) for branch in ('main', 'preview')]
+    assert [status['last_error'] for status in statuses] == [None, None]
+    assert len(fetches) == 1
+    assert views.snapshots.peek('main').sha == git(work, 'rev-parse', 'main')
+    assert views.snapshots.peek('preview').sha == git(work, 'rev-parse', 'preview')
+
+    # A branch pushed since the last fetch is still found
+    git(work, 'checkout', '-q', '-b', 'new')
+    git(work, 'commit', '-q', '--allow-empty', '-m', 'New branch')
+    views.refresh_data('new')
+    assert views.snapshots.peek('new').sha == git(work, 'rev-parse', 'new')
+    assert len(fetches) == 2
+
+
+def test_ingest_matches_json():
+    documents = [
+        b'{"code": "GB-COH", "quality": 0.1, "list": [1, 2.50, -0.0, 1e-7, true, null]}',
+        '{"name": {"en": "Soci\u00e9t\u00e9", "local": "\\u00e9\\ud83d\\ude00"}}'.encode(),
+        b'{"a": 1, "b": 2, "a": 3}',
+        b'{"big": 123456789012345678901234567890, "nan": NaN}',
+    ]
+    for document in documents:
+        parsed = ingest.loads(document)
+        assert parsed == json.loads(document.decode('utf-8'))
+        assert json.dumps(parsed) == json.dumps(json.loads(document.decode('utf-8')))
+    with pytest.raises(ValueError):
+        ingest.loads(b'{"code": ')
+
+    reads = [lambda number=number: json.dumps({'number': number}).encode() for number in range(200)]
+    parsed, read_seconds, decode_seconds = ingest.parse_files(reads, workers=3)
+    assert parsed == [{'number': number} for number in range(200)]
+    assert read_seconds >= 0 and decode_seconds >= 0
+
+
+def test_compact_records():
+    org_id_lists = [
+        {'code': 'GB-COH', 'structure': ['company'], 'quality_explained': {'License: Open': 10}, 'values': [1, 1.0, True, -0.0]},
+        {'code': 'GB-SC', 'structure': ['company'], 'quality_explained': {'License: Open': 10}, 'values': [True, 1.0, 1, 0.0]},
+    ]
+    compactor = Compactor()
+    compacted = [compactor.compact(org_id_list) for org_id_list in org_id_lists]
+    first, second = compacted
+    assert isinstance(first, ListRecord) and first['structure'] == ('company', )
+    assert first['quality_explained'] is second['quality_explained']
+    assert first['structure'] is second['structure']
+    assert first['values'] is not second['values']
+    assert dict(first['quality_explained']) == {'License: Open': 10}
+    assert first.get('missing', 'default') == 'default' and 'code' in first and list(first) == list(org_id_lists[0])
+    assert dict(first, extra=1)['extra'] == 1
+    for org_id_list, record in zip(org_id_lists, compacted):
+        plain = to_plain(record)
+        assert plain == org_id_list and json.dumps(plain) == json.dumps(org_id_list)
+        assert to_plain(pickle.loads(pickle.dumps(record))) == org_id_list
+
+
+def test_snapshot():
+    snapshot = make_snapshot()
+    assert list(snapshot.lists) == ['GB-COH', 'GB-SC', 'GB-NHS', 'FR-RCS', 'XI-ANY']
+    assert snapshot.lists['GB-COH']['structure'] == ('company/limited', 'company')
+    assert snapshot.lists['GB-COH']['quality'] == 60
+    assert snapshot.titles['GB-SC']['subnationalCoverage_titles'] == ['GB-SCT']
+
+    all_results = filter_and_score_results({'coverage': 'GB', 'structure': 'company'}, snapshot)
+    assert [result['code'] for result in all_results['suggested']] == ['GB-COH']
+    assert [result['code'] for result in all_results['recommended']] == ['GB-NHS']
+    assert [result['code'] for result in all_results['other']] == ['XI-ANY']
+    assert all_results['suggested'][0]['relevance'] == 47
+    assert all_results['suggested'][0]['coverage_titles'] == ['GB']
+    assert 'relevance' not in snapshot.lists['GB-COH']
+
+    valid_lookups = get_lookups({'coverage': 'FR'}, snapshot)
+    assert valid_lookups['structure'] == [('company', 'Company', False), ('charity', 'Charity', False)]
+    assert valid_lookups['subnational'] == []
+
+    valid_lookups = get_lookups({'coverage': 'GB', 'structure': 'charity'}, snapshot)
+    assert valid_lookups['coverage'] == [('FR', 'FR', False), ('GB', 'GB', False)]
+    assert valid_lookups['subnational'] == [('GB-SCT', 'GB-SCT', False), ('GB-WLS', 'GB-WLS', True)]
+
+
+class FakeSnapshot:
+    def __init__(self, sha, payload=0):
+        self.sha = sha
+        self.payload = 'x' * payload
+        self.artifacts = {}
+
+
+def test_snapshot_store(monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(store.time, 'time', lambda: now[0])
+    evicted = []
+    snapshots = SnapshotStore(pinned=('main',), max_branches=3, idle_ttl=60, on_evict=evicted.append)
+
+    for branch in ('main', 'pr-1', 'pr-2', 'pr-3'):
+        snapshots.publish(branch, FakeSnapshot(branch))
+    # Over max_branches, so the least recently used preview goes, never main
+    assert evicted == ['pr-1']
+    assert snapshots.get('pr-2').sha == 'pr-2'
+
+    now[0] += 30
+    snapshots.get('pr-3')
+    now[0] += 40
+    assert snapshots.get('main').sha == 'main'
+    assert evicted == ['pr-1', 'pr-2']
+    assert [entry['branch'] for entry in snapshots.report()] == ['pr-3', 'main']
+
+    # Republishing a branch does not count as using it
+    snapshots.publish('pr-6', FakeSnapshot('pr-6'))
+    now[0] += 40
+    snapshots.publish('pr-6', FakeSnapshot('pr-6'))
+    snapshots.get('main')
+    now[0] += 40
+    snapshots.get('main')
+    assert 'pr-6' not in snapshots
+    assert evicted[-1] == 'pr-6'
+
+    snapshots = SnapshotStore(memory_budget=250000, on_evict=evicted.append)
+    snapshots.publish('main', FakeSnapshot('main', 100000))
+    snapshots.publish('pr-4', FakeSnapshot('pr-4', 100000))
+    snapshots.publish('pr-5', FakeSnapshot('pr-5', 100000))
+    assert evicted[-1] == 'pr-4'
+    assert 'pr-5' in snapshots and 'main' in snapshots
+
+    # Objects held by several snapshots are counted once, split between them
+    snapshots = SnapshotStore()
+    lists = ['x' * 100000]
+    snapshots.publish('main', FakeSnapshot('main'), shared=lists)
+    alone = snapshots.report()[0]['memory_bytes']
+    snapshots.publish('pr-7', FakeSnapshot('pr-7'), shared=lists)
+    report = snapshots.report()
+    assert sum(entry['memory_bytes'] for entry in report) < alone + 1000
+    assert abs(report[0]['memory_bytes'] - report[1]['memory_bytes']) < 1000
+
+
+def test_refresher_single_flight():
+    release = threading.Event()
+    calls = []
+
+    def refresh(branch):
+        calls.append(branch)
+        release.wait(5)
+        if branch == 'broken':
+            raise ValueError('no such branch')
+        return 'Loaded ' + branch
+
+    refresher = Refresher(refresh, lambda: ['main'])
+    assert refresher.request('main')['in_flight']
+    assert refresher.request('main')['in_flight']
+    release.set()
+    while refresher.status('main')['in_flight']:
+        time.sleep(0.01)
+    status = refresher.status('main')
+    assert calls == ['main']
+    assert status['last_result'] == 'Loaded main'
+    assert status['last_error'] is None
+    assert not status['in_flight']
+
+    status = refresher.request('broken', wait=True)
+    assert status['last_error'] == "ValueError('no such branch')"
+
+
+def test_shared_snapshot_files(tmp_path):
+    writer = SharedSnapshotFiles(str(tmp_path), RegisterSnapshot.format_version)
+    reader = SharedSnapshotFiles(str(tmp_path), RegisterSnapshot.format_version)
+    assert reader.load_if_changed('test') is None
+
+    snapshot = make_snapshot()
+    snapshot.artifacts['json'] = 'built download'
+    with writer.lock('test'):
+        writer.save('test', snapshot)
+    assert writer.load_if_changed('test') is None
+
+    loaded = reader.load_if_changed('test')
+    assert loaded.sha == 'abc123'
+    assert loaded.lists == snapshot.lists
+    assert loaded.artifacts == {}
+    # Only read again once another save replaces the file
+    assert reader.load_if_changed('test') is None
+
+    other_format = SharedSnapshotFiles(str(tmp_path), RegisterSnapshot.format_version + 1)
+    assert other_format.load_if_changed('test') is None
+
+
+def test_shared_snapshot_files_refuse_open_directory(tmp_path):
+    directory = tmp_path / 'shared'
+    writer = SharedSnapshotFiles(str(directory), RegisterSnapshot.format_version)
+    writer.save('test', make_snapshot())
+    assert directory.stat().st_mode & 0o777 == 0o700
+
+    # Anyone could have written the file once others can write to the directory
+    directory.chmod(0o777)
+    reader = SharedSnapshotFiles(str(directory), RegisterSnapshot.format_version)
+    assert reader.load_if_changed('test') is None
+    with pytest.raises(PermissionError):
+        writer.save('test', make_snapshot())
+    with pytest.raises(PermissionError):
+        with writer.lock('test'):
+            pass
+
+    directory.chmod(0o700)
+    (directory / 'test.pickle').chmod(0o666)
+    assert SharedSnapshotFiles(str(directory), RegisterSnapshot.format_version).load_if_changed('test') is None
+
+
+class SynchronousRefresher:
+    '''Stands in for a Refresher, refreshing in the calling thread as soon as asked, so tests do not race it'''
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+
+    def start(self):
+        pass
+
+    def request(self, branch, wait=False):
+        self.refresh(branch)
+        return {'branch': branch}
+
+
+def test_get_snapshot_warms_from_shared_snapshot(tmp_path, monkeypatch):
+    shared = SharedSnapshotFiles(str(tmp_path), RegisterSnapshot.format_version)
+    shared.save('warm', make_snapshot('warm'))
+    shared._seen.clear()
+    refreshed = []
+    monkeypatch.setattr(views, 'shared_snapshots', shared)
+    monkeypatch.setattr(views, 'snapshots', SnapshotStore())
+    monkeypatch.setattr(views, 'startup_timings', {})
+    monkeypatch.setattr(views, 'refresher', SynchronousRefresher(refreshed.append))
+
+    snapshot = get_snapshot('warm')
+    assert snapshot.sha == 'abc123'
+    assert views.startup_timings['warm']['source'] == 'shared snapshot'
+    # GitHub is still checked, but in the background
+    assert refreshed == ['warm']
+
+    # Newer snapshots saved by other workers are left for the background refresh to read
+    newer = make_snapshot('warm')
+    newer.sha = 'def456'
+    SharedSnapshotFiles(str(tmp_path), RegisterSnapshot.format_version).save('warm', newer)
+    assert get_snapshot('warm') is snapshot
+    views.load_shared_snapshot('warm')
+    assert get_snapshot('warm').sha == 'def456'
+
+
+def test_refresh_checks_github_once_per_interval(tmp_path, monkeypatch, settings):
+    settings.LOCAL_DATA = False
+    settings.GIT_MIRROR_DIR = ''
+    settings.LOCAL_DATA_DIR = str(tmp_path / 'no-register')
+    settings.REFRESH_INTERVAL = 300
+    archive = make_archive(make_schemas(), make_org_id_lists()).fp.getvalue()
+    checks = []
+
+    def get_branch_commit(branch):
+        checks.append(branch)
+        if branch == 'unreachable':
+            raise ConnectionError('GitHub is down')
+        return 'abc123', datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+    monkeypatch.setattr(github, 'get_branch_commit', get_branch_commit)
+    monkeypatch.setattr(github, 'fetch_archive', lambda branch, etag=None: (io.BytesIO(archive), '"etag"'))
+    monkeypatch.setattr(views, 'query_cache', QueryCache())
+    # Two workers, sharing snapshots
+    workers = [(SnapshotStore(), SharedSnapshotFiles(str(tmp_path / 'shared'), RegisterSnapshot.format_version)) for _ in range(2)]
+
+    def refresh(worker, branch='main'):
+        monkeypatch.setattr(views, 'snapshots', workers[worker][0])
+        monkeypatch.setattr(views, 'shared_snapshots', workers[worker][1])
+        return views.refresh_data(branch)
+
+    assert refresh(0) == 'Loaded from github: abc123'
+    assert refresh(1) == 'Not checking GitHub as another worker just did: abc123'
+    assert checks == ['main']
+    assert workers[1][0].peek('main').sha == 'abc123'
+    assert workers[1][0].peek('main').changed_at == datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+    # Once the interval has passed, the next worker checks again
+    os.utime(workers[0][1].path('main', 'checked'), (0, 0))
+    assert refresh(1) == 'Not updating as sha has not changed: abc123'
+    assert checks == ['main', 'main']
+
+    # A branch loaded from GitHub is kept when GitHub cannot be reached, rather than loaded from disk
+    workers[0][0].publish('unreachable', make_snapshot('unreachable'))
+    with pytest.raises(ConnectionError):
+        refresh(0, 'unreachable')
+    assert workers[0][0].peek('unreachable').sha == 'abc123'
+
+
+def test_timing_spans(monkeypatch):
+    monkeypatch.setattr(timing, 'span_seconds', timing.Histogram('test_span_seconds', 'Test spans.', 'span', buckets=(0.5, 10)))
+
+    def view(request):
+        for _ in range(3):
+            with timing.span('scoring'):
+                pass
+        return HttpResponse()
+
+    response = timing.TimingMiddleware(view)(RequestFactory().get('/'))
+    entries = response['Server-Timing'].split(', ')
+    assert entries[0].startswith('scoring;dur=') and entries[0].endswith(';desc="3 calls"')
+    assert entries[-1].startswith('total;dur=')
+
+    # Outside a request, such as in a refresh, each span is recorded straight away
+    with timing.span('refresh_parse'):
+        pass
+    timing.span_seconds.observe('refresh_parse', 5)
+    lines = timing.span_seconds.render().splitlines()
+    assert lines[:2] == ['# HELP test_span_seconds Test spans.', '# TYPE test_span_seconds histogram']
+    assert 'test_span_seconds_bucket{span="refresh_parse",le="0.5"} 1' in lines
+    assert 'test_span_seconds_bucket{span="refresh_parse",le="10"} 2' in lines
+    assert 'test_span_seconds_bucket{span="refresh_parse",le="+Inf"} 2' in lines
+    assert 'test_span_seconds_count{span="refresh_parse"} 2' in lines
+    assert 'test_span_seconds_count{span="scoring"} 1' in lines
+
+
+def test_artifact_response(monkeypatch):
+    publish_main(monkeypatch)
+
+    def download(**headers):
+        request = RequestFactory().get('/download.json', **headers)
+        request.session = {}
+        return views.json_download(request)
+
+    response = download()
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response
+    assert json.loads(response.content)['lists'][0]['code'] == 'GB-COH'
+    assert response['ETag'] == '"abc123-json"'
+    assert response['Content-Disposition'] == 'attachment; filename="org-id-abc123.json"'
+    assert 'Accept-Encoding' in response['Vary']
+    last_modified = response['Last-Modified']
+    # When the commit was made, so the same from every worker
+    assert last_modified == 'Thu, 02 Jan 2020 03:04:05 GMT'
+
+    gzipped = download(HTTP_ACCEPT_ENCODING='deflate, gzip;q=0.5')
+    assert gzipped['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(gzipped.content) == response.content
+    assert gzipped['ETag'] == '"abc123-json-gzip"'
+    assert gzipped['Last-Modified'] == last_modified
+    for accept_encoding in ('gzip;q=0', 'identity', '*;q=0', 'gzip;q=0, *'):
+        assert 'Content-Encoding' not in download(HTTP_ACCEPT_ENCODING=accept_encoding), accept_encoding
+    assert download(HTTP_ACCEPT_ENCODING='*')['Content-Encoding'] == 'gzip'
+
+    # Conditional requests only match the ETag of the same encoding
+    not_modified = download(HTTP_IF_NONE_MATCH='"abc123-json"')
+    assert not_modified.status_code == 304
+    assert not_modified.content == b''
+    assert not_modified['ETag'] == '"abc123-json"'
+    assert download(HTTP_IF_NONE_MATCH='"abc123-json-gzip"', HTTP_ACCEPT_ENCODING='gzip').status_code == 304
+    assert download(HTTP_IF_NONE_MATCH='"abc123-json"', HTTP_ACCEPT_ENCODING='gzip').status_code == 200
+    assert download(HTTP_IF_NONE_MATCH='"abc123-csv"').status_code == 200
+    assert download(HTTP_IF_MODIFIED_SINCE=last_modified).status_code == 304
+
+
+def test_csv_download_fields(monkeypatch):
+    publish_main(monkeypatch)
+    response = get(views.csv_download, '/download.csv', {'fields': 'sector, code,name/en,subnationalCoverage'})
+    assert response.streaming
+    assert response['Content-Disposition'] == 'attachment; filename="org-id-abc123.csv"'
+    # Columns in the order asked for, empty where a list has no value
+    assert b''.join(response.streaming_content).decode().splitlines() == [
+        'sector,code,name/en,subnationalCoverage',
+        ',GB-COH,GB-COH register,',
+        ',GB-SC,GB-SC register,GB-SCT',
+        'health,GB-NHS,GB-NHS register,',
+        ',FR-RCS,FR-RCS register,',
+        ',XI-ANY,XI-ANY register,',
+    ]
+
+    response = get(views.csv_download, '/download.csv', {'fields': 'code,colour,name'})
+    assert response.status_code == 400
+    assert response.content == b'Unknown fields: colour, name'
+
+
+def test_api_results(monkeypatch):
+    publish_main(monkeypatch)
+    response = get(views.api_results, '/api/results', {'coverage': 'GB', 'fields': 'code,name/en,coverage_titles'})
+    data = json.loads(response.content)
+    assert data['total'] == 4
+    assert data['counts'] == {'suggested': 1, 'recommended': 2, 'other': 1}
+    assert data['results']['suggested'] == [{'code': 'GB-COH', 'name/en': 'GB-COH register', 'coverage_titles': ['GB']}]
+    assert [result['code'] for result in data['results']['recommended']] == ['GB-SC', 'GB-NHS']
+
+    data = json.loads(get(views.api_results, '/api/results', {'coverage': 'GB', 'offset': 1, 'limit': 1}).content)
+    assert data['results'] == {'suggested': [], 'recommended': [{'code': 'GB-SC', 'name': {'en': 'GB-SC register'}, 'quality': 60, 'relevance': 32}], 'other': []}
+
+    assert get(views.api_results, '/api/results', {'fields': 'code,secret'}).status_code == 400
+    assert get(views.api_results, '/api/results', {'limit': 'all'}).status_code == 400
+
+
+def test_recommend_batch_matches_single_queries():
+    snapshot = make_snapshot()
+    queries = [
+        {}, {'coverage': 'GB'}, {'coverage': 'GB', 'subnational': 'GB-SCT'}, {'coverage': 'FR', 'structure': 'company'},
+        {'structure': 'company', 'substructure': 'company/limited'}, {'sector': 'health'}, {'coverage': 'ZZ'},
+    ] * 3
+    for query, recommendations in zip(queries, views.recommend_batch(queries, snapshot, limit=None)):
+        results = filter_and_score_results(query, snapshot)
+        expected = [
+            {'code': result['code'], 'band': band, 'relevance': result.relevance, 'quality': result['quality']}
+            for band in ('suggested', 'recommended', 'other') for result in results[band]
+        ]
+        assert recommendations == expected
+        assert [type(r['relevance']) for r in recommendations] == [type(r['relevance']) for r in expected]
+
+    assert [len(r) for r in views.recommend_batch(queries[:3], snapshot, limit=2)] == [2, 2, 1]
+
+
+def test_api_recommend(monkeypatch):
+    publish_main(monkeypatch)
+    factory = RequestFactory()
+
+    request = factory.post('/api/recommend?limit=2', json.dumps([{'id': 1, 'coverage': 'GB'}, {'id': 2, 'coverage': 'FR'}]),
+                           content_type='application/json')
+    request.session = {}
+    data = json.loads(b''.join(views.api_recommend(request).streaming_content))
+    assert data[0]['query'] == {'id': 1, 'coverage': 'GB'}
+    assert [(r['code'], r['band']) for r in data[0]['results']] == [('GB-COH', 'suggested'), ('GB-SC', 'recommended')]
+    assert data[1]['results'][0]['code'] == 'FR-RCS'
+
+    request = factory.post('/api/recommend?limit=1', 'id,coverage,sector\nA,GB,health\nB,ZZ,\n', content_type='text/csv')
+    request.session = {}
+    lines = b''.join(views.api_recommend(request).streaming_content).decode().splitlines()
+    assert lines == ['id,coverage,sector,rank,code,band,relevance,quality', 'A,GB,health,1,GB-NHS,suggested,67.0,60', 'B,ZZ,,1,XI-ANY,other,4,60']
+
+    request = factory.post('/api/recommend', '{"coverage": "GB"}', content_type='application/json')
+    request.session = {}
+    assert views.api_recommend(request).status_code == 400
+
+    request = factory.post('/api/recommend', 'id,coverage\nA,C\xf4te\n'.encode('latin-1'), content_type='text/csv')
+    request.session = {}
+    assert views.api_recommend(request).status_code == 400
+
+
+def test_api_recommend_uploads(monkeypatch):
+    publish_main(monkeypatch)
+    client = Client()
+
+    # JSON is told apart from CSV by its name or content type
+    upload = io.BytesIO(json.dumps([{'id': 1, 'coverage': 'FR'}]).encode())
+    upload.name = 'organisations.json'
+    response = client.post('/api/recommend?limit=1', {'file': upload})
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'application/json'
+    data = json.loads(b''.join(response.streaming_content))
+    assert [result['code'] for result in data[0]['results']] == ['FR-RCS']
+
+    upload = io.BytesIO(b'{"coverage": "FR"}')
+    upload.name = 'organisations.json'
+    assert client.post('/api/recommend', {'file': upload}).status_code == 400
+
+    upload = io.BytesIO('id,coverage\nA,C\xf4te\n'.encode('latin-1'))
+    upload.name = 'organisations.csv'
+    assert client.post('/api/recommend', {'file': upload}).status_code == 400
+
+
+def test_api_recommend_large_upload(monkeypatch):
+    publish_main(monkeypatch)
+    # Over the 2.5 MB Django holds in memory, through every middleware
+    rows = 30000
+    content = 'id,coverage\n' + ''.join('{:0100d},GB\n'.format(number) for number in range(rows))
+    assert len(content) > 2.5 * 1024 * 1024
+    client = Client()
+
+    upload = io.BytesIO(content.encode())
+    upload.name = 'organisations.csv'
+    response = client.post('/api/recommend?limit=1', {'file': upload})
+    assert response.status_code == 200
+    lines = b''.join(response.streaming_content).decode().splitlines()
+    assert len(lines) == rows + 1
+    assert lines[-1] == '{:0100d},GB,1,GB-COH,suggested,37.0,60'.format(rows - 1)
+
+    # Bodies that large are refused, as documented
+    assert client.post('/api/recommend', content, content_type='text/csv').status_code == 400
+
+
+def test_prefix_index():
+    prefixes = PrefixIndex([
+        {'code': 'GB-COH', 'formerPrefixes': ['GB-CHC-OLD']},
+        {'code': 'GB-COH-NI'},
+        {'code': 'XM-DAC', 'formerPrefixes': ['DAC', 'GB-COH-NI']},
+    ])
+    assert prefixes.resolve('GB-COH-09506232') == ('GB-COH', None, 'GB-COH', '09506232')
+    assert prefixes.resolve(' gb-coh-ni-123 ') == ('GB-COH-NI', None, 'gb-coh-ni', '123')
+    assert prefixes.resolve('GB-COH') == ('GB-COH', None, 'GB-COH', '')
+    assert prefixes.resolve('DAC-1-2') == ('XM-DAC', 'DAC', 'DAC', '1-2')
+    assert prefixes.resolve('GB-CHC-OLD-5') == ('GB-COH', 'GB-CHC-OLD', 'GB-CHC-OLD', '5')
+    assert prefixes.resolve('GB-COHX-1') is None
+    assert prefixes.resolve('GB') is None
+
+
+def test_api_resolve(monkeypatch):
+    publish_main(monkeypatch)
+    data = json.loads(get(views.api_resolve, '/api/resolve', {'identifier': 'GB-SC-SC012345'}).content)
+    assert (data['code'], data['id'], data['deprecated']) == ('GB-SC', 'SC012345', False)
+    assert data['list']['name'] == {'en': 'GB-SC register'}
+    assert get(views.api_resolve, '/api/resolve', {'identifier': 'XX-DRAFT-1'}).status_code == 404
+
+    request = RequestFactory().post('/api/resolve/bulk', 'FR-RCS-123\n\nnope\nGB-COH-1\n', content_type='text/plain')
+    request.session = {}
+    lines = b''.join(views.api_resolve_bulk(request).streaming_content).decode().splitlines()
+    assert lines == [
+        'identifier,code,prefix,id,former_prefix,deprecated,name',
+        'FR-RCS-123,FR-RCS,FR-RCS,123,,False,FR-RCS register',
+        'nope',
+        'GB-COH-1,GB-COH,GB-COH,1,,False,GB-COH register',
+    ]
+
+
+def test_api_resolve_bulk_large_upload(monkeypatch):
+    publish_main(monkeypatch)
+    identifiers = ['GB-COH-{:0100d}'.format(number) for number in range(25000)]
+    content = '\n'.join(identifiers) + '\n'
+    assert len(content) > 2.5 * 1024 * 1024
+    client = Client()
+
+    upload = io.BytesIO(content.encode())
+    upload.name = 'identifiers.txt'
+    response = client.post('/api/resolve/bulk', {'file': upload})
+    assert response.status_code == 200
+    lines = b''.join(response.streaming_content).decode().splitlines()
+    assert len(lines) == len(identifiers) + 1
+    assert lines[-1] == '{},GB-COH,GB-COH,{:0100d},,False,GB-COH register'.format(identifiers[-1], len(identifiers) - 1)
+
+    assert client.post('/api/resolve/bulk', content, content_type='text/plain').status_code == 400
+
+
+def test_search_index():
+    assert tokenize('Société Générale, GB-COH') == ['societe', 'generale', 'gb', 'coh']
+    index = SearchIndex([
+        {'code': 'GB-COH', 'name': {'en': 'Companies House'}, 'description': {'en': 'Companies in the UK'}, 'quality': 80},
+        {'code': 'GB-CHC', 'name': {'en': 'Charity Commission'}, 'quality': 60, 'formerPrefixes': ['GB-CC']},
+        {'code': 'GB-HOUSE', 'name': {'en': 'Housing Associations', 'local': 'Tai'}, 'quality': 20},
+        {'code': 'FR-RCS', 'name': {'en': 'Trade and Companies Register', 'local': 'Registre du Commerce et des Sociétés'}, 'quality': 100},
+    ])
+    assert [code for code, score in index.search('companies house')] == ['GB-COH']
+    assert [code for code, score in index.search('charity comm')] == ['GB-CHC']
+    assert [code for code, score in index.search('hou')] == ['GB-HOUSE', 'GB-COH']
+    assert index.search('hou ') == []
+    assert index.search('hou', prefix=False) == []
+    assert [code for code, score in index.search('companies')] == ['GB-COH', 'FR-RCS']
+    assert [code for code, score in index.search('companies', limit=1)] == ['GB-COH']
+    assert [code for code, score in index.search('societes')] == ['FR-RCS']
+    assert [code for code, score in index.search('gb-cc')] == ['GB-CHC']
+    assert [code for code, score in index.search('gb')] == ['GB-COH', 'GB-CHC', 'GB-HOUSE']
+    assert index.search('') == index.search(' - ') == []
+
+
+def test_api_search(monkeypatch):
+    publish_main(monkeypatch)
+    data = json.loads(get(views.api_search, '/api/search', {'q': 'gb-s'}).content)
+    assert [result['code'] for result in data['results']] == ['GB-SC']
+    data = json.loads(get(views.api_search, '/api/search', {'q': 'register', 'limit': 2, 'fields': 'code,name/en'}).content)
+    assert len(data['results']) == 2
+    assert set(data['results'][0]) == {'code', 'name/en', 'score'}
+    assert get(views.api_search, '/api/search', {'q': 'gb', 'limit': 'x'}).status_code == 400
+    data = json.loads(get(views.api_search, '/api/search', {'q': 'gb-sc', 'fields': 'name,coverage_titles'}).content)
+    assert data['results'][0] == {'name': {'en': 'GB-SC register'}, 'coverage_titles': ['GB'], 'score': data['results'][0]['score']}
+    response = get(views.api_search, '/api/search', {'q': 'gb', 'fields': 'code,colour,relevance'})
+    assert response.status_code == 400
+    assert response.content == b'Unknown fields: colour, relevance'
+
+
+def make_random_snapshot(count=300, seed=0):
+    '''A snapshot of lists with random codes from make_schemas, including ties and unknown codes'''
+    rnd = random.Random(seed)
+
+    def some(*codes):
+        return rnd.sample(codes, rnd.randint(1, len(codes))) if rnd.random() < 0.6 else rnd.choice([None, []])
+
+    org_id_lists = []
+    for number in range(count):
+        org_id_lists.append({
+            'code': 'XX-{}'.format(number),
+            'confirmed': rnd.random() < 0.95,
+            'listType': rnd.choice(['primary', 'secondary', None]),
+            'coverage': some('GB', 'FR', 'DE'),
+            'subnationalCoverage': some('GB-SCT', 'GB-WLS'),
+            'structure': some('company', 'charity', 'company/limited'),
+            'sector': some('health', 'education'),
+            'data': {'availability': rnd.choice([[], ['api']]), 'licenseStatus': rnd.choice([None, 'open_license'])},
+            'description': {'en': 'List {}. Made up for tests.'.format(number)},
+            'access': {'availableOnline': rnd.random() < 0.5, 'languages': ['en']},
+            'links': {},
+            'meta': {'source': 'tests'},
+        })
+    return RegisterSnapshot('random', make_schemas(), org_id_lists)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_scoring_engines_match(seed, settings):
+    snapshot = make_random_snapshot(seed=seed)
+    for query in every_query():
+        settings.SCORING_ENGINE = 'python'
+        expected = filter_and_score_results(query, snapshot)
+        settings.SCORING_ENGINE = 'numpy'
+        results = filter_and_score_results(query, snapshot)
+        for band in ('suggested', 'recommended', 'other'):
+            assert [result['code'] for result in results[band]] == [result['code'] for result in expected[band]]
+            assert [(result.relevance, type(result.relevance)) for result in results[band]] == \
+                [(result.relevance, type(result.relevance)) for result in expected[band]]
+            assert [result.relevance_debug for result in results[band]] == [result.relevance_debug for result in expected[band]]
+            assert all(result.band == band for result in results[band])
+
+
+# The original scoring and lookups, from before lists were indexed, to check the faster versions against.
+# They take the lists as plain dicts keyed by code, and the lookups, instead of reading globals.
+def original_add_titles(org_list, lookups):
+    coverage_codes = org_list.get('coverage')
+    if coverage_codes:
+        org_list['coverage_titles'] = [tup[1] for tup in lookups['coverage'] if tup[0] in coverage_codes]
+        org_list['coverage_codes_and_titles'] = [tup for tup in lookups['coverage'] if tup[0] in coverage_codes]
+    subnational_codes = org_list.get('subnationalCoverage')
+    if subnational_codes:
+        subnational_coverage = []
+        # The original failed for lists with subnational areas but no coverage, or a country without any
+        for country in coverage_codes or []:
+            subnational_coverage.extend(lookups['subnational'].get(country, []))
+        org_list['subnationalCoverage_titles'] = [tup[1] for tup in subnational_coverage if tup[0] in subnational_codes]
+
+    structure_codes = org_list.get('structure')
+    if structure_codes:
+        org_list['structure_titles'] = [tup[1] for tup in lookups['structure'] if tup[0] in structure_codes]
+
+    sector_codes = org_list.get('sector')
+    if sector_codes:
+        org_list['sector_titles'] = [tup[1] for tup in lookups['sector'] if tup[0] in sector_codes]
+
+
+def original_filter_and_score_results(query, org_id_dict, lookups):
+    indexed = {key: value.copy() for key, value in org_id_dict.items()}
+    for prefix in list(indexed.values()):
+        prefix['relevance'] = 0
+        prefix['relevance_debug'] = []
+
+    coverage = query.get('coverage')
+    subnational = query.get('subnational')
+    structure = query.get('structure')
+    substructure = query.get('substructure')
+    sector = query.get('sector')
+
+    for prefix in list(indexed.values()):
+        if prefix.get('listType') == 'primary':
+            prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"]
+            prefix['relevance_debug'].append("Primary list +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
+
+        if coverage:
+            if prefix.get('coverage'):
+                if coverage in prefix['coverage']:
+                    prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"]
+                    prefix['relevance_debug'].append("Coverage matched: +" + str(RELEVANCE["MATCH_DROPDOWN"]))
+                    if len(prefix['coverage']) == 1:
+                        prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]
+                        prefix['relevance_debug'].append("List only covers this country +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
+                    if not subnational and not prefix.get('subnationalCoverage'):
+                        prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"] / 2
+                        prefix['relevance_debug'].append("List is only national +" + str(RELEVANCE["MATCH_DROPDOWN"] / 2))
+                else:
+                    indexed.pop(prefix['code'], None)
+        else:
+            if not prefix.get('coverage'):
+                prefix['relevance'] += RELEVANCE["MATCH_EMPTY"]
+                prefix['relevance_debug'].append("No coverage value +" + str(RELEVANCE["MATCH_DROPDOWN"]))
+
+        if subnational:
+            if prefix.get('subnationalCoverage') and subnational in prefix['subnationalCoverage']:
+                prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"] * 2
+                prefix['relevance_debug'].append("Subnational coverage matched +" + str(RELEVANCE["MATCH_DROPDOWN"] * 2))
+                if len(prefix['subnationalCoverage']) == 1:
+                    prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]
+                    prefix['relevance_debug'].append("List only covers this subnational area +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
+            else:
+                indexed.pop(prefix['code'], None)
+
+        if structure:
+            if prefix.get('structure'):
+                if structure in prefix['structure']:
+                    prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"]
+                    prefix['relevance_debug'].append("Structure matched +" + str(RELEVANCE["MATCH_DROPDOWN"]))
+                    if len(prefix['structure']) == 1:
+                        prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]
+                        prefix['relevance_debug'].append("List only covers this structure +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
+                else:
+                    indexed.pop(prefix['code'], None)
+        else:
+            if not prefix.get('structure'):
+                prefix['relevance'] += RELEVANCE["MATCH_EMPTY"]
+                prefix['relevance_debug'].append("No structure value +" + str(RELEVANCE["MATCH_EMPTY"]))
+
+        if substructure:
+            if prefix.get('structure') and substructure in prefix['structure']:
+                prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"] * 2
+                prefix['relevance_debug'].append("Sub-structure matched +" + str(RELEVANCE["MATCH_DROPDOWN"] * 2))
+            else:
+                indexed.pop(prefix['code'], None)
+
+        if sector:
+            if prefix.get('sector'):
+                if sector in prefix['sector']:
+                    prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"] * 2
+                    prefix['relevance_debug'].append("Sector matched +" + str(RELEVANCE["MATCH_DROPDOWN"] * 2))
+                    if len(prefix['sector']) == 1:
+                        prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"] * 2
+                        prefix['relevance_debug'].append("List only covers this sector +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"] * 2))
+                else:
+                    indexed.pop(prefix['code'], None)
+        else:
+            if not prefix.get('sector'):
+                prefix['relevance'] += RELEVANCE["MATCH_EMPTY"]
+                prefix['relevance_debug'].append("Sector empty +" + str(RELEVANCE["MATCH_EMPTY"]))
+
+    all_results = {"suggested": [],
+                   "recommended": [],
+                   "other": []}
+
+    if not indexed:
+        return all_results
+
+    for num, value in enumerate(sorted(indexed.values(), key=lambda k: -(k['relevance'] * 100 + k['quality']))):
+        original_add_titles(value, lookups)
+
+        good_enough = value['relevance'] >= RELEVANCE["SUGGESTED_RELEVANCE_THRESHOLD"] and value['quality'] > RELEVANCE["SUGGESTED_QUALITY_THRESHOLD"]
+        if good_enough and not all_results['suggested'] or (all_results['suggested'] and value['relevance'] == all_results['suggested'][0]['relevance']):
+            all_results['suggested'].append(value)
+        elif value['relevance'] >= RELEVANCE["RECOMMENDED_RELEVANCE_THRESHOLD"]:
+            all_results['recommended'].append(value)
+        else:
+            all_results['other'].append(value)
+
+    return all_results
+
+
+def original_get_lookups(query_dict, org_id_dict, lookups):
+    valid_lookups = {
+        'coverage': None,
+        'structure': None,
+        'sector': None,
+        'subnational': None,
+        'substructure': None
+    }
+
+    coverage = query_dict.get('coverage')
+    structure = query_dict.get('structure')
+    subnational_lookups = []
+    substructure_lookups = []
+
+    queries = []
+    fields = ('coverage', 'structure', 'sector', 'subnational', 'substructure')
+
+    for field in fields:
+        if field == 'subnational' or field == 'substructure':
+            single_query = {'lookups': field}
+        else:
+            single_query = {'lookups': (field, [[], False])}
+
+        for key, value in query_dict.items():
+            if key == field:
+                single_query[field] = ''
+            else:
+                single_query[key] = value
+        queries.append(single_query)
+
+    for q in queries:
+        indexed = {key: value for key, value in org_id_dict.items()}
+        for org_list in list(indexed.values()):
+            for key, value in q.items():
+                if key == 'lookups':
+                    continue
+                if value:
+                    if key == 'subnational' or key == 'substructure':
+                        key = 'subnationalCoverage' if key == 'subnational' else 'structure'
+                        if org_list.get(key) and value not in org_list[key] or not org_list.get(key):
+                            indexed.pop(org_list['code'], None)
+                    else:
+                        if org_list.get(key) and value not in org_list[key]:
+                            indexed.pop(org_list['code'], None)
+
+        if isinstance(q['lookups'], tuple):
+            field, field_lookup = q['lookups']
+            for result in indexed.values():
+                if result.get(field):
+                    field_lookup[0].extend([item for item in result[field]])
+                else:
+                    field_lookup[1] = True
+                    break
+            else:
+                field_lookup[0] = set(field_lookup[0])
+
+        elif q['lookups'] == 'subnational' and coverage:
+            for result in indexed.values():
+                if result.get('subnationalCoverage'):
+                    subnational_lookups.extend([region for region in result['subnationalCoverage']])
+            subnational_lookups = set(subnational_lookups)
+        elif q['lookups'] == 'substructure' and structure:
+            for result in indexed.values():
+                if result.get('structure'):
+                    substructure_lookups.extend([structure for structure in result['structure']])
+            substructure_lookups = set(substructure_lookups)
+
+    for q in queries:
+        if isinstance(q['lookups'], tuple):
+            field, field_lookup = q['lookups']
+            if field_lookup[1]:
+                valid_lookups[field] = lookups[field]
+            else:
+                valid_lookups[field] = [tup if tup[0] in field_lookup[0] else (tup[0], tup[1], True) for tup in lookups[field]]
+
+    if lookups['subnational'].get(coverage):
+        if subnational_lookups:
+            valid_lookups['subnational'] = [
+                tup if tup[0] in subnational_lookups else (tup[0], tup[1], True)
+                for tup in lookups['subnational'][coverage]
+            ]
+        else:
+            valid_lookups['subnational'] = [(tup[0], tup[1], True) for tup in lookups['subnational'][coverage]]
+    else:
+        valid_lookups['subnational'] = []
+
+    if lookups['substructure'].get(structure):
+        if substructure_lookups:
+            valid_lookups['substructure'] = [
+                tup if tup[0] in substructure_lookups else (tup[0], tup[1], True)
+                for tup in lookups['substructure'][structure]
+            ]
+        else:
+            valid_lookups['substructure'] = [(tup[0], tup[1], True) for tup in lookups['substructure'][structure]]
+    else:
+        valid_lookups['substructure'] = []
+
+    return valid_lookups
+
+
+QUERY_VALUES = {
+    'coverage': [None, 'GB', 'FR', 'DE', 'ZZ'],
+    'subnational': [None, 'GB-SCT', 'GB-WLS'],
+    'structure': [None, 'company', 'charity'],
+    'substructure': [None, 'company/limited'],
+    'sector': [None, 'health', 'education'],
+}
+
+
+def every_query():
+    '''Every combination of the dropdowns set or not, with values that are and are not in the schemas'''
+    for combination in itertools.product(*QUERY_VALUES.values()):
+        yield {key: value for key, value in zip(QUERY_VALUES, combination) if value}
+
+
+@pytest.mark.parametrize('engine', ['python', 'numpy'])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_scoring_matches_original(seed, engine, settings):
+    settings.SCORING_ENGINE = engine
+    snapshot = make_random_snapshot(seed=seed)
+    org_id_dict = {code: to_plain(org_list) for code, org_list in snapshot.lists.items()}
+    tied = 0
+    for query in every_query():
+        expected = original_filter_and_score_results(query, org_id_dict, snapshot.lookups)
+        results = filter_and_score_results(query, snapshot)
+        for band in ('suggested', 'recommended', 'other'):
+            assert [(result['code'], result.relevance, result.relevance_debug) for result in results[band]] == \
+                [(value['code'], value['relevance'], value['relevance_debug']) for value in expected[band]]
+            assert [result.titles for result in results[band]] == \
+                [{key: value[key] for key in value if key.endswith('_titles')} for value in expected[band]]
+            assert all(result.band == band for result in results[band])
+        tied += len({result.relevance for result in results['suggested']}) < len(results['suggested'])
+    # Lists tied with the best suggestion are suggested too
+    assert tied
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_lookups_match_original(seed):
+    # Few enough lists for some options to find none
+    snapshot = make_random_snapshot(count=5, seed=seed)
+    org_id_dict = {code: to_plain(org_list) for code, org_list in snapshot.lists.items()}
+    greyed_out = 0
+    for query in every_query():
+        valid_lookups = get_lookups(query, snapshot)
+        assert valid_lookups == original_get_lookups(query, org_id_dict, snapshot.lookups)
+        greyed_out += sum(1 for values in valid_lookups.values() for value in values if value[2])
+    assert greyed_out
+
+
+def test_tidy_results_scored_lists():
+    snapshot = make_random_snapshot(seed=0)
+    results = filter_and_score_results({'coverage': 'GB', 'sector': 'health'}, snapshot)
+    for result in results['suggested'] + results['recommended'] + results['other']:
+        for length in (None, 'long'):
+            plain = dict(result.org_list, **result.titles, relevance=result.relevance, relevance_debug=result.relevance_debug)
+            expected = list(tidy_results(plain, length))
+            result_items = list(tidy_results(result, length))
+            assert result_items == expected
+            assert (('Relevance', result.relevance) in result_items) == bool(result.relevance)
@@ -0,0 +1,128 @@
+import bisect
+import contextlib
+import threading
+import time
+from collections import OrderedDict
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    '''Prometheus histogram with one label, kept in memory by this process'''
+
+    def __init__(self, name, help, label, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            series['buckets'][index] += 1
+            series['sum'] += seconds
+            series['count'] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = '{}="{}"'.format(self.label, label_value)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), series['buckets']):
+                    cumulative += count
+                    bound = bound if bound == '+Inf' else format(bound, 'g')
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, bound, cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(self.name, label, repr(series['sum'])))
+                lines.append('{}_count{{{}}} {}'.format(self.name, label, series['count']))
+        return '\n'.join(lines) + '\n'
+
+
+span_seconds = Histogram(
+    'prefix_finder_span_seconds',
+    'Time spent in each stage of a request or data refresh, per request or refresh.',
+    'span',
+)
+request_seconds = Histogram(
+    'prefix_finder_request_seconds',
+    'Time taken to handle a request, by view, not counting streamed content.',
+    'view',
+)
+
+# Spans recorded so far in the request being handled by this thread
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def span(name):
+    '''Time a block, or a function when used as a decorator.
+
+    Within a request, time spent in spans with the same name is added up
+    and recorded once when the request ends. Elsewhere, such as in a
+    background refresh, each span is recorded as it finishes.
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def record(name, seconds):
+    '''Record time measured some other way, such as added up over threads, as a span'''
+    spans = getattr(_local, 'spans', None)
+    if spans is None:
+        span_seconds.observe(name, seconds)
+    else:
+        total = spans.get(name)
+        if total is None:
+            spans[name] = [seconds, 1]
+        else:
+            total[0] += seconds
+            total[1] += 1
+
+
+def server_timing(spans, total):
+    '''Format spans for the Server-Timing header, with durations in milliseconds'''
+    entries = []
+    for name, (seconds, count) in spans.items():
+        entry = '{};dur={:.2f}'.format(name, seconds * 1000)
+        if count > 1:
+            entry += ';desc="{} calls"'.format(count)
+        entries.append(entry)
+    entries.append('total;dur={:.2f}'.format(total * 1000))
+    return ', '.join(entries)
+
+
+class TimingMiddleware:
+    '''Records the spans of each request, and returns them in a Server-Timing header'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.spans = spans = OrderedDict()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.spans = None
+        total = time.perf_counter() - started
+
+        for name, (seconds, count) in spans.items():
+            span_seconds.observe(name, seconds)
+        match = request.resolver_match
+        request_seconds.observe(match.url_name if match and match.url_name else 'unmatched', total)
+        response['Server-Timing'] = server_timing(spans, total)
+        return response
+
+
+def render_metrics():
+    '''All metrics in the Prometheus text format'''
+    return span_seconds.render() + request_seconds.render()
@@ -7,7 +7,15 @@ from . import views
 urlpatterns = [
     url(r'^$', views.home, name='home'),
     url(r'^results$', views.results, name='results'),
+    url(r'^api/results$', views.api_results, name='api_results'),
+    url(r'^api/recommend$', views.api_recommend, name='api_recommend'),
+    url(r'^api/resolve$', views.api_resolve, name='api_resolve'),
+    url(r'^api/resolve/bulk$', views.api_resolve_bulk, name='api_resolve_bulk'),
+    url(r'^api/search$', views.api_search, name='api_search'),
     url(r'^_update_lists$', views.update_lists, name='update_lists'),
+    url(r'^_cache_stats$', views.cache_stats, name='cache_stats'),
+    url(r'^_snapshots$', views.snapshot_report, name='snapshot_report'),
+    url(r'^_metrics$', views.metrics, name='metrics'),
     url(r'^_preview_branch/([A-Za-z0-9-]+)$', views.preview_branch, name='preview_branch'),
     url(r'^terms', TemplateView.as_view(template_name='terms.html'), name='terms'),
     url(r'^about', TemplateView.as_view(template_name='about.html'), name='about'),
@@ -3,18 +3,46 @@
 # * Contine work on edit view to fetch updated list
 
 import os
+import io
 import json
+import codecs
+import contextlib
+import copy
+import time
 import glob
 import zipfile
-import io
 import csv
-from collections import OrderedDict
+import gzip
+import hashlib
+import itertools
+import subprocess
+import zlib
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+
+import numpy as np
 
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, Http404, JsonResponse, StreamingHttpResponse
 from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from . import github
+from . import ingest
+from . import mirror
+from . import timing
+from .cache import QueryCache
+from .records import Compactor, to_plain
+from .refresher import Refresher
+from .resolver import PrefixIndex
+from .scoring import FeatureMatrix, BAND_NAMES
+from .search import SearchIndex
+from .shared import SharedSnapshotFiles
+from .store import SnapshotStore
 
-import requests
 import datetime
 
 RELEVANCE = {
@@ -26,36 +54,115 @@ RELEVANCE = {
     "SUGGESTED_QUALITY_THRESHOLD": 45
 }
 
-current_dir = os.path.dirname(os.path.realpath(__file__))
-
 ##globals
-lookups = None
-org_id_dict = {}
-git_commit_ref = {'master':''}
-branch = 'main'
-
-
-def load_schemas_from_github(branch="main"):
-    schemas = {}
-    response = requests.get("https://github.com/org-id/register/archive/"+branch+".zip")
-    with zipfile.ZipFile(io.BytesIO(response.content)) as ziped_repo:
-        for filename in ziped_repo.namelist():
-            filename_split = filename.split("/")[1:]
-            if len(filename_split) == 2 and filename_split[0] == "schema" and filename_split[-1].endswith(".json"):
-                with ziped_repo.open(filename) as schema_file:
-                    schemas[filename_split[-1].split(".")[0]] = json.loads(schema_file.read().decode('utf-8'))
-    print("Loaded schemas from GitHub")
-    return schemas
-
-
-def load_schemas_from_disk():
-    schemas = {}
-    schema_dir = os.path.join(current_dir, '../../schema')
-    for file_path in glob.glob(schema_dir + '/*.json'):
-        with open(file_path) as data:
-            schemas[file_path.split('/')[-1].split(".")[0]] = json.load(data)
+# When this module was imported, and how long after that each branch was
+# first ready to serve, see get_snapshot
+import_time = time.time()
+startup_timings = {}
+query_cache = QueryCache(settings.QUERY_CACHE_SIZE, settings.QUERY_CACHE_BACKEND)
+# The RegisterSnapshot currently published for each loaded branch
+snapshots = SnapshotStore(
+    pinned=('main',),
+    max_branches=settings.SNAPSHOT_MAX_BRANCHES,
+    idle_ttl=settings.SNAPSHOT_IDLE_TTL,
+    memory_budget=settings.SNAPSHOT_MEMORY_BUDGET_MB * 1024 * 1024,
+    on_evict=query_cache.invalidate,
+)
+
+
+def _register_file_kind(path):
+    ''''schema' or 'lists' for the files of the register that are loaded, given paths like lists/gb/gb-coh.json'''
+    parts = path.split("/")
+    if not parts[-1].endswith(".json"):
+        return None
+    if len(parts) == 2 and parts[0] == "schema":
+        return "schema"
+    if len(parts) == 3 and parts[0] == "lists":
+        return "lists"
+    return None
+
+
+def iter_archive_files(ziped_repo):
+    '''Get (path, crc, read) for the files in a zip archive of the register, without reading them'''
+    for info in ziped_repo.infolist():
+        path = info.filename.split("/", 1)[-1]
+        if _register_file_kind(path):
+            yield path, info.CRC, lambda info=info: ziped_repo.read(info)
+
+
+def _read_disk_files(file_paths):
+    contents = []
+    for file_path in file_paths:
+        with open(file_path, 'rb') as data:
+            contents.append(data.read())
+    return contents
+
+
+def _disk_file_paths():
+    data_dir = os.path.join(settings.LOCAL_DATA_DIR, '')
+    patterns = (os.path.join('schema', '*.json'), os.path.join('lists', '*', '*.json'))
+    return data_dir, [file_path for pattern in patterns for file_path in glob.glob(data_dir + pattern)]
+
+
+def iter_disk_files():
+    '''Get (path, crc, read) for the files of the register in LOCAL_DATA_DIR, reading them with LOAD_WORKERS threads'''
+    data_dir, file_paths = _disk_file_paths()
+    contents = itertools.chain.from_iterable(ingest.map_chunks(_read_disk_files, file_paths, settings.LOAD_WORKERS))
+    for file_path, content in zip(file_paths, contents):
+        path = file_path[len(data_dir):].replace(os.sep, "/")
+        yield path, zlib.crc32(content), lambda content=content: content
+
+
+def disk_changed_at():
+    '''Get when the register in LOCAL_DATA_DIR last changed, from its files' modification times'''
+    data_dir, file_paths = _disk_file_paths()
+    mtimes = [os.stat(file_path).st_mtime for file_path in file_paths]
+    return datetime.datetime.fromtimestamp(max(mtimes, default=0), datetime.timezone.utc)
+
+
+def read_register(files, previous=()):
+    '''Parse the schemas and org id lists of the register from (path, crc, read) for each file.
+
+    Lists whose file has the same path and crc as in one of the previous
+    snapshots with exactly the same schemas are taken from it as they are,
+    already augmented, without being read. If the schemas have changed,
+    everything is parsed again. Returns the schemas, the lists, and the crc
+    of each file with the list parsed from it, keyed by path, for
+    RegisterSnapshot.
+    '''
+    started = time.perf_counter()
+    files = [(path, crc, read, _register_file_kind(path)) for path, crc, read in files]
+    list_seconds = time.perf_counter() - started
+    schema_crcs = {path: crc for path, crc, read, kind in files if kind == "schema"}
+    schemas = None
+    reusable = {}
+    for snapshot in previous:
+        if schema_crcs and schema_crcs == {path: crc for path, (crc, org_id_list) in snapshot.sources.items() if org_id_list is None}:
+            schemas = snapshot.schemas
+            for path, source in snapshot.sources.items():
+                reusable.setdefault(path, {}).setdefault(source[0], source[1])
+    schema_files = [] if schemas is not None else [(path, crc, read) for path, crc, read, kind in files if kind == "schema"]
+    list_files = [(path, crc, read) for path, crc, read, kind in files if kind == "lists"]
+    new_files = [(path, crc, read) for path, crc, read in list_files if crc not in reusable.get(path, {})]
+
+    parsed, read_seconds, decode_seconds = ingest.parse_files((read for path, crc, read in schema_files + new_files), settings.LOAD_WORKERS)
+    parsed = dict(zip((path for path, crc, read in schema_files + new_files), parsed))
+    if schemas is None:
+        schemas = {path.split("/")[-1].split(".")[0]: parsed[path] for path, crc, read in schema_files}
+
+    sources = {path: (crc, None) for path, crc in schema_crcs.items()}
+    org_id_lists = []
+    for path, crc, read in list_files:
+        org_id_list = parsed[path] if path in parsed else reusable[path][crc]
+        sources[path] = (crc, org_id_list)
+        org_id_lists.append(org_id_list)
 
-    return schemas
+    for name, seconds in (('refresh_list', list_seconds), ('refresh_read', read_seconds), ('refresh_decode', decode_seconds)):
+        timing.record(name, seconds)
+    print("Listed {} files in {:.3f}s, read {} in {:.3f}s and decoded them in {:.3f}s{}".format(
+        len(files), list_seconds, len(parsed), read_seconds, decode_seconds, " with orjson" if ingest.orjson else ""
+    ))
+    return schemas, org_id_lists, sources
 
 
 def create_codelist_lookups(schemas):
@@ -86,28 +193,6 @@ def create_codelist_lookups(schemas):
     return lookups
 
 
-def load_org_id_lists_from_github(branch="main"):
-    org_id_lists = []
-    response = requests.get("https://github.com/org-id/register/archive/"+branch+".zip")
-    with zipfile.ZipFile(io.BytesIO(response.content)) as ziped_repo:
-        for filename in ziped_repo.namelist():
-            filename_split = filename.split("/")[1:]
-            if len(filename_split) == 3 and filename_split[0] == "lists" and filename_split[-1].endswith(".json"):
-                with ziped_repo.open(filename) as schema_file:
-                    org_id_lists.append(json.loads(schema_file.read().decode('utf-8')))
-    return org_id_lists
-
-
-def load_org_id_lists_from_disk():
-    codes_dir = os.path.join(current_dir, '../../lists')
-    org_id_lists = []
-    for org_id_list_file in glob.glob(codes_dir + '/*/*.json'):
-        with open(org_id_list_file) as org_id_list:
-            org_id_lists.append(json.load(org_id_list))
-
-    return org_id_lists
-
-
 def augment_quality(schemas, org_id_lists):
     availabilty_score = {item['code']: item['quality_score'] for item in schemas['codelist-availability']['availability']}
     availabilty_names = {item['code']: item['title']['en'] for item in schemas['codelist-availability']['availability']}
@@ -153,318 +238,743 @@ def augment_structure(org_id_lists):
                 prefix['structure'].append(split[0])
 
 
-def add_titles(org_list):
-    '''Add coverage_titles and subnationalCoverage_titles to organization lists'''
-    coverage_codes = org_list.get('coverage')
-    if coverage_codes:
-        org_list['coverage_titles'] = [tup[1] for tup in lookups['coverage'] if tup[0] in coverage_codes]
-        org_list['coverage_codes_and_titles'] = [tup for tup in lookups['coverage'] if tup[0] in coverage_codes]
-    subnational_codes = org_list.get('subnationalCoverage')
-    if subnational_codes:
-        subnational_coverage = []
-        for country in coverage_codes:
-            subnational_coverage.extend(lookups['subnational'][country])
-        org_list['subnationalCoverage_titles'] = [tup[1] for tup in subnational_coverage if tup[0] in subnational_codes]
+def build_titles(lookups, org_id_lists):
+    '''Get coverage_titles, subnationalCoverage_titles etc. for each organization list, keyed by code.
+
+    Titles are in the same order as the lookups they come from.
+    '''
+    positions = {
+        field: {tup[0]: position for position, tup in enumerate(lookups[field])}
+        for field in ('coverage', 'structure', 'sector')
+    }
+
+    def in_lookup_order(field, codes):
+        return [lookups[field][position] for position in sorted({positions[field][code] for code in codes if code in positions[field]})]
+
+    all_titles = {}
+    for org_list in org_id_lists:
+        titles = {}
+        coverage_codes = org_list.get('coverage')
+        if coverage_codes:
+            titles['coverage_codes_and_titles'] = in_lookup_order('coverage', coverage_codes)
+            titles['coverage_titles'] = [tup[1] for tup in titles['coverage_codes_and_titles']]
+        subnational_codes = org_list.get('subnationalCoverage')
+        if subnational_codes:
+            subnational_coverage = []
+            for country in coverage_codes or []:
+                subnational_coverage.extend(lookups['subnational'].get(country, []))
+            titles['subnationalCoverage_titles'] = [tup[1] for tup in subnational_coverage if tup[0] in subnational_codes]
+
+        structure_codes = org_list.get('structure')
+        if structure_codes:
+            titles['structure_titles'] = [tup[1] for tup in in_lookup_order('structure', structure_codes)]
+
+        sector_codes = org_list.get('sector')
+        if sector_codes:
+            titles['sector_titles'] = [tup[1] for tup in in_lookup_order('sector', sector_codes)]
+
+        all_titles[org_list['code']] = titles
+    return all_titles
+
+
+class ScoredList:
+    '''An organization list as scored for one query.
+
+    Holds references to the shared list from a snapshot and its titles,
+    which are never copied or modified, plus the relevance and band worked
+    out for the query. Item access falls through to the list and titles, so
+    templates can treat it as one. If relevance_debug is not given, it is
+    worked out from query the first time it is used.
+    '''
+    __slots__ = ('org_list', 'titles', 'relevance', '_relevance_debug', 'band', 'query')
+
+    def __init__(self, org_list, titles, relevance, relevance_debug, band=None, query=None):
+        self.org_list = org_list
+        self.titles = titles
+        self.relevance = relevance
+        self._relevance_debug = relevance_debug
+        self.band = band
+        self.query = query
+
+    @property
+    def relevance_debug(self):
+        if self._relevance_debug is None:
+            self._relevance_debug = score_list(self.org_list, self.query)[1]
+        return self._relevance_debug
+
+    def __getitem__(self, key):
+        if key == 'relevance':
+            return self.relevance
+        if key == 'relevance_debug':
+            return self.relevance_debug
+        if key.endswith('_titles'):
+            return self.titles[key]
+        return self.org_list[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-    structure_codes = org_list.get('structure')
-    if structure_codes:
-        org_list['structure_titles'] = [tup[1] for tup in lookups['structure'] if tup[0] in structure_codes]
+    def __repr__(self):
+        return '<ScoredList {} relevance={} band={}>'.format(self.org_list['code'], self.relevance, self.band)
 
-    sector_codes = org_list.get('sector')
-    if sector_codes:
-        org_list['sector_titles'] = [tup[1] for tup in lookups['sector'] if tup[0] in sector_codes]
 
+# Bit offsets set in each possible byte value, used to walk bitsets quickly
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
 
-def refresh_data(branch="main"):
-    global lookups
-    global org_id_dict
-    global git_commit_ref
+INDEXED_FIELDS = ('coverage', 'subnationalCoverage', 'structure', 'sector')
 
-    try:
-        sha = requests.get(
-            'https://api.github.com/repos/org-id/register/branches/'+branch,
-            auth=(settings.GITHUB_USER, settings.GITHUB_API_TOKEN) if settings.GITHUB_USER and settings.GITHUB_API_TOKEN else ''
-        ).json()['commit']['sha']
-        using_github = True
-        if sha == git_commit_ref.get(branch,''):
-            return "Not updating as sha has not changed: {}".format(sha)
-    except Exception:
-        using_github = False
 
-    if settings.LOCAL_DATA:
-        using_github = False
+def _make_bitset(positions):
+    bits = bytearray(max(positions) // 8 + 1 if positions else 0)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
 
-    if using_github:
-        try:
-            print("Starting schema load from GitHub")
-            schemas = load_schemas_from_github(branch)
-        except Exception:
-            raise
-            using_github = False
-            schemas = load_schemas_from_disk()
-    else:
-        print("Loading from disk")
-        schemas = load_schemas_from_disk()
 
-    lookups = create_codelist_lookups(schemas)
+def _bitset_positions(bitset):
+    positions = []
+    for offset, byte in enumerate(bitset.to_bytes((bitset.bit_length() + 7) // 8, 'little')):
+        if byte:
+            offset <<= 3
+            positions.extend(offset + bit for bit in _BYTE_BITS[byte])
+    return positions
 
-    if using_github:
-        try:
-            org_id_lists = load_org_id_lists_from_github(branch)
-        except:
-            raise
-            using_github = False
-            org_id_lists = load_org_id_lists_from_disk()
-    else:
-        org_id_lists = load_org_id_lists_from_disk()
 
-    augment_quality(schemas, org_id_lists)
-    augment_structure(org_id_lists)
+def build_index(org_id_lists):
+    '''Build an inverted index of the filterable fields of the given lists.
 
-    org_id_dict[branch] = {org_id_list['code']: org_id_list for org_id_list in org_id_lists if org_id_list.get('confirmed')}
+    Each field maps its codes to a bitset (an int) of positions in
+    index['lists']; '<field>_empty' holds the lists with no value for it.
+    Structure codes include substructures, as augment_structure has run.
+    '''
+    index = {
+        'lists': list(org_id_lists),
+        'all': (1 << len(org_id_lists)) - 1,
+    }
+    for field in INDEXED_FIELDS:
+        postings = {}
+        empty = []
+        for position, org_list in enumerate(index['lists']):
+            codes = org_list.get(field)
+            if codes:
+                for code in codes:
+                    postings.setdefault(code, []).append(position)
+            else:
+                empty.append(position)
+        index[field] = {code: _make_bitset(positions) for code, positions in postings.items()}
+        index[field + '_empty'] = _make_bitset(empty)
+    return index
+
+
+# Query keys that filter lists, and the list field each one matches against
+QUERY_FIELDS = OrderedDict((
+    ('coverage', 'coverage'),
+    ('structure', 'structure'),
+    ('sector', 'sector'),
+    ('subnational', 'subnationalCoverage'),
+    ('substructure', 'structure'),
+))
+
+
+def query_masks(index, query):
+    '''Get a bitset of the lists allowed by each part of the query'''
+    masks = {}
+    for key, field in QUERY_FIELDS.items():
+        value = query.get(key)
+        if not value:
+            continue
+        if key in ('subnational', 'substructure'):
+            masks[key] = index[field].get(value, 0)
+        else:
+            # Lists with no coverage, structure or sector are not filtered out by them
+            masks[key] = index[field].get(value, 0) | index[field + '_empty']
+    return masks
+
+
+def filter_positions(index, query):
+    '''Positions in index['lists'] of the lists filter_and_score_results keeps for query'''
+    mask = index['all']
+    for key_mask in query_masks(index, query).values():
+        mask &= key_mask
+    return _bitset_positions(mask)
+
+
+def data_version(sha, sources):
+    '''Identify the data of a snapshot, from its commit and the crc of each file.
+
+    Every worker that loads the same files gets the same version, and it
+    changes whenever a file does, even when loading from disk without a sha.
+    '''
+    files = sorted((path, crc) for path, (crc, org_id_list) in sources.items())
+    return hashlib.sha1(json.dumps([sha, files]).encode('utf-8')).hexdigest()
+
+
+class RegisterSnapshot:
+    '''Everything loaded from one commit of a branch of the register.
+
+    Bump format_version whenever what a snapshot holds changes, so that
+    snapshots saved by older code are not loaded.
+
+    A snapshot is built completely before it is published in snapshots, and
+    is not changed afterwards (apart from downloads being added to artifacts
+    the first time they are asked for). Requests should call get_snapshot
+    once and use that snapshot throughout, so they see consistent data even
+    if the branch is refreshed meanwhile.
+    '''
+
+    format_version = 11
+
+    def __init__(self, branch, schemas, org_id_lists, sha='', archive_etag=None, sources=None, previous=(), changed_at=None):
+        # Lists taken from previous snapshots by read_register were augmented for them
+        reused = {}
+        for snapshot in previous:
+            for crc, org_id_list in snapshot.sources.values():
+                reused.setdefault(id(org_id_list), snapshot)
+        new_lists = [org_id_list for org_id_list in org_id_lists if id(org_id_list) not in reused]
+        augment_quality(schemas, new_lists)
+        augment_structure(new_lists)
+        # Keep new lists as ListRecords, sharing what is repeated between them
+        compactor = Compactor()
+        with timing.span('refresh_compact'):
+            compacted = {id(org_id_list): compactor.compact(org_id_list) for org_id_list in new_lists}
+        org_id_lists = [compacted.get(id(org_id_list), org_id_list) for org_id_list in org_id_lists]
+        sources = {
+            path: (crc, compacted.get(id(org_id_list), org_id_list))
+            for path, (crc, org_id_list) in (sources or {}).items()
+        }
 
-    if using_github:
-        git_commit_ref[branch] = sha
+        self.branch = branch
+        self.sha = sha
+        self.archive_etag = archive_etag
+        self.loaded_at = datetime.datetime.now(datetime.timezone.utc)
+        # When the commit was made, or the files changed when loading from disk, so the same in every worker
+        self.changed_at = changed_at or self.loaded_at
+        self.schemas = schemas
+        # The crc of each file loaded, keyed by path, with the list parsed from it (None for schemas), see read_register
+        self.sources = sources
+        self.version = data_version(sha, sources)
+        self.parsed_lists = len(new_lists)
+        # Snapshots share schemas when read_register found them unchanged
+        self.lookups = next((snapshot.lookups for snapshot in previous if snapshot.schemas is schemas), None) or create_codelist_lookups(schemas)
+        self.lists = {org_id_list['code']: org_id_list for org_id_list in org_id_lists if org_id_list.get('confirmed')}
+        self.index = build_index(self.lists.values())
+        self.prefixes = PrefixIndex(self.lists.values())
+        self.search = SearchIndex(self.lists.values(), [snapshot.search for snapshot in previous])
+
+        # Titles and columns only depend on the list, as a list is only
+        # reused from snapshots with the same schemas
+        owners = {}
+        for code, org_id_list in self.lists.items():
+            owner = reused.get(id(org_id_list))
+            if owner is not None and owner.lists.get(code) is org_id_list:
+                owners[code] = owner
+        titles = build_titles(self.lookups, [org_id_list for code, org_id_list in self.lists.items() if code not in owners])
+        self.titles = {code: owners[code].titles[code] if code in owners else titles[code] for code in self.lists}
+        # The flattened paths used by each list, keyed by code
+        self.columns = {
+            code: owners[code].columns[code] if code in owners else list_columns(org_id_list)
+            for code, org_id_list in self.lists.items()
+        }
+        self.csv_headers = get_csv_headers(self.columns.values())
+        # Downloads, built on first use by get_artifact
+        self.artifacts = {}
+        self._features = None
+
+    @property
+    def features(self):
+        '''The lists as a FeatureMatrix, for scoring queries in bulk, built on first use'''
+        if self._features is None:
+            self._features = FeatureMatrix(self.index['lists'], RELEVANCE)
+        return self._features
+
+    def for_commit(self, branch, sha, archive_etag=None, changed_at=None):
+        '''Get a snapshot of another commit with exactly the same files, sharing everything with this one'''
+        snapshot = copy.copy(self)
+        snapshot.branch = branch
+        snapshot.sha = sha
+        snapshot.version = data_version(sha, self.sources)
+        snapshot.archive_etag = archive_etag
+        snapshot.loaded_at = datetime.datetime.now(datetime.timezone.utc)
+        snapshot.changed_at = changed_at or snapshot.loaded_at
+        snapshot.parsed_lists = 0
+        snapshot.artifacts = {}
+        return snapshot
+
+    def shared_parts(self):
+        '''What later snapshots may reuse: the lists, what is worked out from each alone, and, for
+        snapshots of commits with the same files, everything else'''
+        parts = [org_id_list for crc, org_id_list in self.sources.values() if org_id_list is not None]
+        parts.extend(self.lists.values())
+        parts.extend(self.titles.values())
+        parts.extend(self.columns.values())
+        parts.extend(counts for org_list, counts in self.search._word_counts.values())
+        parts.extend((self.schemas, self.sources, self.lookups, self.lists, self.index, self.prefixes, self.search, self.titles, self.columns))
+        return parts
+
+    def __getstate__(self):
+        # Downloads and features are large and quick to rebuild, so are not saved
+        return dict(self.__dict__, artifacts={}, _features=None)
+
+    def __repr__(self):
+        return '<RegisterSnapshot {} {}>'.format(self.branch, self.sha or 'from disk')
+
+
+def get_snapshot(branch="main"):
+    '''Get the published snapshot of a branch, loading the branch if needed.
+
+    The first time a branch is asked for, a snapshot saved by any worker is
+    used straight away if there is one, and GitHub is checked for a newer
+    commit in the background. Only if there is none does this wait for the
+    branch to load. Once a branch is loaded, newer snapshots saved by other
+    workers are only picked up by the background refresh, so requests never
+    wait for one to be read.
+    '''
+    refresher.start()
+    first_use = branch not in snapshots
+    started = time.time()
+    if first_use:
+        load_shared_snapshot(branch)
+    snapshot = snapshots.get(branch)
+    if snapshot is not None:
+        if first_use:
+            refresher.request(branch)
+            _record_startup(branch, 'shared snapshot', started)
+        return snapshot
+
+    # Wait for the branch to load, joining a load already in progress
+    status = refresher.request(branch, wait=True)
+    snapshot = snapshots.get(branch)
+    if snapshot is None:
+        raise RuntimeError('Could not load branch {}: {}'.format(branch, status.get('last_error')))
+    _record_startup(branch, 'refresh', started)
+    return snapshot
+
+
+def _record_startup(branch, source, started):
+    if branch in startup_timings:
+        return
+    now = time.time()
+    startup_timings[branch] = {
+        'source': source,
+        'load_seconds': round(now - started, 3),
+        'seconds_since_import': round(now - import_time, 3),
+    }
+    print("Branch {} ready from {} in {:.3f}s".format(branch, source, now - started))
+
+
+def publish_snapshot(snapshot):
+    snapshots.publish(snapshot.branch, snapshot, snapshot.shared_parts())
+    query_cache.invalidate(snapshot.branch)
+
+
+def load_shared_snapshot(branch):
+    '''Publish the snapshot of branch saved by any worker, if it changed since we last looked'''
+    if shared_snapshots is None:
+        return None
+    snapshot = shared_snapshots.load_if_changed(branch)
+    if snapshot is not None:
+        publish_snapshot(snapshot)
+    return snapshot
+
+
+def refresh_data(branch="main"):
+    load_shared_snapshot(branch)
+    current = snapshots.peek(branch)
+
+    sha = ''
+    changed_at = None
+    using_github = using_mirror = False
+    if settings.LOCAL_DATA:
+        pass
+    elif settings.GIT_MIRROR_DIR:
+        with timing.span('refresh_sha'):
+            # Refreshes of every branch in a poll share one fetch
+            fetched = settings.GIT_MIRROR_FETCH and mirror.fetch(settings.REFRESH_INTERVAL)
+            try:
+                sha = mirror.get_branch_sha(branch)
+            except subprocess.CalledProcessError:
+                # The branch may have been pushed since the last fetch
+                if not settings.GIT_MIRROR_FETCH or fetched:
+                    raise
+                mirror.fetch()
+                sha = mirror.get_branch_sha(branch)
+        using_mirror = True
+        if current and sha == current.sha:
+            return "Not updating as sha has not changed: {}".format(sha)
+
+    # Only one worker checks GitHub for a branch at a time and refreshes it,
+    # saving the result for the others
+    with shared_snapshots.lock(branch) if shared_snapshots else contextlib.nullcontext():
+        shared = load_shared_snapshot(branch)
+        current = snapshots.peek(branch)
+        if not settings.LOCAL_DATA and not settings.GIT_MIRROR_DIR:
+            # Keep to GitHub's rate limit by checking each branch once per interval, whichever worker does it
+            if current and current.sha and shared_snapshots and shared_snapshots.checked_within(branch, settings.REFRESH_INTERVAL):
+                return "Not checking GitHub as another worker just did: {}".format(current.sha)
+            try:
+                with timing.span('refresh_sha'):
+                    sha, changed_at = github.get_branch_commit(branch)
+            except Exception:
+                # Loading from disk instead is only for when GitHub could not be reached at all
+                if current and current.sha:
+                    raise
+            else:
+                using_github = True
+                if shared_snapshots:
+                    shared_snapshots.mark_checked(branch)
+        if (using_github or using_mirror) and shared and shared.sha == sha:
+            return "Loaded snapshot saved by another worker: {}".format(sha)
+        if using_github and current and sha == current.sha:
+            return "Not updating as sha has not changed: {}".format(sha)
+        previous = [current] if current else []
+
+        etag = None
+        if using_mirror:
+            print("Loading from git mirror")
+            # Object ids identify files on any branch, so lists can be shared with every loaded branch
+            previous = [snapshot for snapshot in map(snapshots.peek, snapshots.branches()) if snapshot is not None]
+            changed_at = mirror.get_commit_time(sha)
+            with mirror.BlobReader() as blobs, timing.span('refresh_parse'):
+                schemas, org_id_lists, sources = read_register(mirror.iter_files(sha, blobs), previous)
+        elif using_github:
+            print("Starting load from GitHub")
+            with timing.span('refresh_download'):
+                archive, etag = github.fetch_archive(branch, current.archive_etag if current else None)
+            if archive is None:
+                return "Not updating as archive has not changed: {}".format(sha)
+            with archive, zipfile.ZipFile(archive) as ziped_repo, timing.span('refresh_parse'):
+                schemas, org_id_lists, sources = read_register(iter_archive_files(ziped_repo), previous)
+        else:
+            print("Loading from disk")
+            with timing.span('refresh_parse'):
+                schemas, org_id_lists, sources = read_register(iter_disk_files(), previous)
+            changed_at = disk_changed_at()
+
+        crcs = {path: crc for path, (crc, org_id_list) in sources.items()}
+        same = [snapshot for snapshot in previous if {path: crc for path, (crc, org_id_list) in snapshot.sources.items()} == crcs]
+        if current in same and sha == current.sha:
+            return "Not updating as no files have changed"
+        elif same:
+            # Only files outside the register changed, or another branch has the same files
+            snapshot = same[0].for_commit(branch, sha, etag, changed_at)
+        else:
+            with timing.span('refresh_augment'):
+                snapshot = RegisterSnapshot(branch, schemas, org_id_lists, sha=sha, archive_etag=etag, sources=sources, previous=previous, changed_at=changed_at)
+        print("Parsed {} of {} lists, reusing the rest".format(snapshot.parsed_lists, len(org_id_lists)))
+        # Publish the new snapshot in one go
+        with timing.span('refresh_publish'):
+            publish_snapshot(snapshot)
+            if shared_snapshots:
+                shared_snapshots.save(branch, snapshot)
+
+    if using_mirror:
+        return "Loaded from git mirror: {}".format(sha)
+    elif using_github:
         return "Loaded from github: {}".format(sha)
     else:
         return "Loaded from disk"
 
-print(refresh_data())
 
+refresher = Refresher(refresh_data, snapshots.branches, settings.REFRESH_INTERVAL, settings.REFRESH_JITTER)
+shared_snapshots = SharedSnapshotFiles(settings.SHARED_SNAPSHOT_DIR, RegisterSnapshot.format_version) if settings.SHARED_SNAPSHOT_DIR else None
 
-def filter_and_score_results(query,use_branch="main"):
-    indexed = {key: value.copy() for key, value in org_id_dict[use_branch].items()}
-    for prefix in list(indexed.values()):
-        prefix['relevance'] = 0
-        prefix['relevance_debug'] = []
 
+def score_list(prefix, query):
+    '''Get the relevance of a list that passed the filters of query, and why, as (relevance, relevance_debug)'''
     coverage = query.get('coverage')
     subnational = query.get('subnational')
     structure = query.get('structure')
     substructure = query.get('substructure')
     sector = query.get('sector')
 
-    for prefix in list(indexed.values()):
-        if prefix.get('listType') == 'primary':
-            prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"]
-            prefix['relevance_debug'].append("Primary list +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
-
-        if coverage:
-            if prefix.get('coverage'):
-                if coverage in prefix['coverage']:
-                    prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"]
-                    prefix['relevance_debug'].append("Coverage matched: +" + str(RELEVANCE["MATCH_DROPDOWN"]))
-                    if len(prefix['coverage']) == 1:
-                        prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]
-                        prefix['relevance_debug'].append("List only covers this country +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
-                    if not subnational and not prefix.get('subnationalCoverage'):
-                        prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"]/2
-                        prefix['relevance_debug'].append("List is only national +" + str(RELEVANCE["MATCH_DROPDOWN"]/2))
-                else:
-                    indexed.pop(prefix['code'], None)
-        else:
-            if not prefix.get('coverage'):
-                prefix['relevance'] += RELEVANCE["MATCH_EMPTY"]
-                prefix['relevance_debug'].append("No coverage value +" + str(RELEVANCE["MATCH_DROPDOWN"]))
-
-        if subnational:
-            if prefix.get('subnationalCoverage') and subnational in prefix['subnationalCoverage']:
-                prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"] * 2
-                prefix['relevance_debug'].append("Subnational coverage matched +" + str(RELEVANCE["MATCH_DROPDOWN"]*2))
-                if len(prefix['subnationalCoverage']) == 1:
-                    prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]
-                    prefix['relevance_debug'].append("List only covers this subnational area +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
-            else:
-                indexed.pop(prefix['code'], None)
-
-        if structure:
-            if prefix.get('structure'):
-                if structure in prefix['structure']:
-                    prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"]
-                    prefix['relevance_debug'].append("Structure matched +" + str(RELEVANCE["MATCH_DROPDOWN"]))
-                    if len(prefix['structure']) == 1:
-                        prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]
-                        prefix['relevance_debug'].append("List only covers this structure +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
-                else:
-                    indexed.pop(prefix['code'], None)
-        else:
-            if not prefix.get('structure'):
-                prefix['relevance'] += RELEVANCE["MATCH_EMPTY"]
-                prefix['relevance_debug'].append("No structure value +" + str(RELEVANCE["MATCH_EMPTY"]))
-
-        if substructure:
-            if prefix.get('structure') and substructure in prefix['structure']:
-                    prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"] * 2
-                    prefix['relevance_debug'].append("Sub-structure matched +" + str(RELEVANCE["MATCH_DROPDOWN"]*2))
-            else:
-                indexed.pop(prefix['code'], None)
-
-        if sector:
-            if prefix.get('sector'):
-                if sector in prefix['sector']:
-                    prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN"]*2
-                    prefix['relevance_debug'].append("Sector matched +" + str(RELEVANCE["MATCH_DROPDOWN"]*2))
-                    if len(prefix['sector']) == 1:
-                        prefix['relevance'] += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]*2
-                        prefix['relevance_debug'].append("List only covers this sector +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]*2))
-                else:
-                    indexed.pop(prefix['code'], None)
-        else:
-            if not prefix.get('sector'):
-                prefix['relevance'] += RELEVANCE["MATCH_EMPTY"]
-                prefix['relevance_debug'].append("Sector empty +" + str(RELEVANCE["MATCH_EMPTY"]))
+    relevance = 0
+    relevance_debug = []
+
+    if prefix.get('listType') == 'primary':
+        relevance += RELEVANCE["MATCH_DROPDOWN"]
+        relevance_debug.append("Primary list +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
+
+    if coverage:
+        if prefix.get('coverage'):
+            relevance += RELEVANCE["MATCH_DROPDOWN"]
+            relevance_debug.append("Coverage matched: +" + str(RELEVANCE["MATCH_DROPDOWN"]))
+            if len(prefix['coverage']) == 1:
+                relevance += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]
+                relevance_debug.append("List only covers this country +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
+            if not subnational and not prefix.get('subnationalCoverage'):
+                relevance += RELEVANCE["MATCH_DROPDOWN"]/2
+                relevance_debug.append("List is only national +" + str(RELEVANCE["MATCH_DROPDOWN"]/2))
+    else:
+        if not prefix.get('coverage'):
+            relevance += RELEVANCE["MATCH_EMPTY"]
+            relevance_debug.append("No coverage value +" + str(RELEVANCE["MATCH_DROPDOWN"]))
+
+    if subnational:
+        relevance += RELEVANCE["MATCH_DROPDOWN"] * 2
+        relevance_debug.append("Subnational coverage matched +" + str(RELEVANCE["MATCH_DROPDOWN"]*2))
+        if len(prefix['subnationalCoverage']) == 1:
+            relevance += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]
+            relevance_debug.append("List only covers this subnational area +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
+
+    if structure:
+        if prefix.get('structure'):
+            relevance += RELEVANCE["MATCH_DROPDOWN"]
+            relevance_debug.append("Structure matched +" + str(RELEVANCE["MATCH_DROPDOWN"]))
+            if len(prefix['structure']) == 1:
+                relevance += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]
+                relevance_debug.append("List only covers this structure +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]))
+    else:
+        if not prefix.get('structure'):
+            relevance += RELEVANCE["MATCH_EMPTY"]
+            relevance_debug.append("No structure value +" + str(RELEVANCE["MATCH_EMPTY"]))
+
+    if substructure:
+        relevance += RELEVANCE["MATCH_DROPDOWN"] * 2
+        relevance_debug.append("Sub-structure matched +" + str(RELEVANCE["MATCH_DROPDOWN"]*2))
+
+    if sector:
+        if prefix.get('sector'):
+            relevance += RELEVANCE["MATCH_DROPDOWN"]*2
+            relevance_debug.append("Sector matched +" + str(RELEVANCE["MATCH_DROPDOWN"]*2))
+            if len(prefix['sector']) == 1:
+                relevance += RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]*2
+                relevance_debug.append("List only covers this sector +" + str(RELEVANCE["MATCH_DROPDOWN_ONLY_VALUE"]*2))
+    else:
+        if not prefix.get('sector'):
+            relevance += RELEVANCE["MATCH_EMPTY"]
+            relevance_debug.append("Sector empty +" + str(RELEVANCE["MATCH_EMPTY"]))
+
+    return relevance, relevance_debug
+
+
+def filter_and_score_results(query, snapshot):
+    '''Score the lists that pass the filters of query, and split them into bands.
+
+    Uses the engine chosen by the SCORING_ENGINE setting, which give the
+    same results.
+    '''
+    if settings.SCORING_ENGINE == 'numpy':
+        return _filter_and_score_numpy(query, snapshot)
+    return _filter_and_score_python(query, snapshot)
+
+
+def _filter_and_score_python(query, snapshot):
+    index = snapshot.index
+    titles = snapshot.titles
+
+    # Only lists that passed the filters are scored
+    scored = []
+    for position in filter_positions(index, query):
+        prefix = index['lists'][position]
+        relevance, relevance_debug = score_list(prefix, query)
+        code = prefix['code']
+        scored.append(ScoredList(prefix, titles[code], relevance, relevance_debug))
 
     all_results = {"suggested": [],
                    "recommended": [],
                    "other": []}
 
-    if not indexed:
+    if not scored:
         return all_results
 
-    for num, value in enumerate(sorted(indexed.values(), key=lambda k: -(k['relevance'] * 100 + k['quality']))):
-        add_titles(value)
-
-        if (value['relevance'] >= RELEVANCE["SUGGESTED_RELEVANCE_THRESHOLD"]
-            and value['quality'] > RELEVANCE["SUGGESTED_QUALITY_THRESHOLD"]
-            and not all_results['suggested'] or (all_results['suggested'] and value['relevance'] == all_results['suggested'][0]['relevance'])):
-            all_results['suggested'].append(value)
-        elif value['relevance'] >= RELEVANCE["RECOMMENDED_RELEVANCE_THRESHOLD"]:
-            all_results['recommended'].append(value)
+    scored.sort(key=lambda k: -(k.relevance * 100 + k.org_list['quality']))
+    for value in scored:
+        if (value.relevance >= RELEVANCE["SUGGESTED_RELEVANCE_THRESHOLD"]
+            and value.org_list['quality'] > RELEVANCE["SUGGESTED_QUALITY_THRESHOLD"]
+            and not all_results['suggested'] or (all_results['suggested'] and value.relevance == all_results['suggested'][0].relevance)):
+            value.band = 'suggested'
+        elif value.relevance >= RELEVANCE["RECOMMENDED_RELEVANCE_THRESHOLD"]:
+            value.band = 'recommended'
         else:
-            all_results['other'].append(value)
+            value.band = 'other'
+        all_results[value.band].append(value)
 
     return all_results
 
 
-def get_lookups(query_dict, use_branch='main'):
+def _filter_and_score_numpy(query, snapshot):
+    features = snapshot.features
+    keep, relevance, is_float = features.score([query])
+    bands = features.bands(keep, relevance)
+    order = features.ranked(bands, relevance)[0]
+
+    org_id_lists = snapshot.index['lists']
+    titles = snapshot.titles
+    # Ranked lists come in band order, so each band is a slice of them
+    band_ends = np.cumsum(np.bincount(bands[0][order], minlength=len(BAND_NAMES))[:len(BAND_NAMES)]).tolist()
+    relevance = relevance[0][order].tolist()
+    is_float = is_float[0][order].tolist()
+    # relevance_debug is only worked out for the lists it is shown for
+    query = dict(normalize_query(query))
+
+    all_results = {}
+    start = 0
+    for band, end in zip(BAND_NAMES, band_ends):
+        band_results = all_results[band] = []
+        for position, value, value_is_float in zip(order[start:end], relevance[start:end], is_float[start:end]):
+            org_list = org_id_lists[position]
+            code = org_list['code']
+            # The same type of relevance as _filter_and_score_python gives
+            band_results.append(ScoredList(org_list, titles[code], value if value_is_float else int(value), None, band, query))
+        start = end
+    return all_results
+
+
+def get_lookups(query_dict, snapshot):
     ''' Get only those lookup combinations returning some result'''
-    valid_lookups = {
-        'coverage': None,
-        'structure': None,
-        'sector': None,
-        'subnational': None,
-        'substructure': None
-    }
+    index = snapshot.index
+    lookups = snapshot.lookups
+    masks = query_masks(index, query_dict)
 
     # Needed for subcategories
     coverage = query_dict.get('coverage')
     structure = query_dict.get('structure')
-    subnational_lookups = []
-    substructure_lookups = []
-
-    queries = []
-    fields = ('coverage', 'structure', 'sector', 'subnational', 'substructure')
 
-    # Build queries, one per search dropdown
-    for field in fields:
-        if field == 'subnational' or field == 'substructure':
-            single_query = {'lookups': field}
+    def facet_mask(key):
+        '''Lists matching the query with the dropdown for key left blank'''
+        mask = index['all']
+        for other_key, key_mask in masks.items():
+            if other_key != key:
+                mask &= key_mask
+        return mask
+
+    def options(choices, postings, mask):
+        return [tup if postings.get(tup[0], 0) & mask else (tup[0], tup[1], True) for tup in choices]
+
+    valid_lookups = {}
+    for key in ('coverage', 'structure', 'sector'):
+        mask = facet_mask(key)
+        if mask & index[key + '_empty']:
+            # Lists without a value for this field match any option
+            valid_lookups[key] = lookups[key]
         else:
-            single_query = {'lookups': (field, [[], False])}
-
-        for key, value in query_dict.items():
-            if key == field:
-                single_query[field] = ''
-            else:
-                single_query[key] = value
-        queries.append(single_query)
-
-    # Run the queries popping those lists that won't be returned
-    # from a dict (list_code:list_data) of id lists.
-    for q in queries:
-        indexed = {key: value for key, value in org_id_dict[use_branch].items()}
-        for org_list in list(indexed.values()):
-            for key, value in q.items():
-                if key == 'lookups':
-                    continue
-                if value:
-                    if key == 'subnational' or key == 'substructure':
-                        key = 'subnationalCoverage' if key == 'subnational' else 'structure'
-                        if org_list.get(key) and value not in org_list[key] or not org_list.get(key):
-                            indexed.pop(org_list['code'], None)
-                    else:
-                        if org_list.get(key) and value not in org_list[key]:
-                            indexed.pop(org_list['code'], None)
-
-        if isinstance(q['lookups'], tuple):
-            field, field_lookup = q['lookups']
-            for result in indexed.values():
-                if result.get(field):
-                    field_lookup[0].extend([item for item in result[field]])
-                else:
-                    field_lookup[1] = True
-                    break
-            else:
-                field_lookup[0] = set(field_lookup[0])
-
-        elif q['lookups'] == 'subnational' and coverage:
-            for result in indexed.values():
-                if result.get('subnationalCoverage'):
-                    subnational_lookups.extend([region for region in result['subnationalCoverage']])
-            subnational_lookups = set(subnational_lookups)
-        elif q['lookups'] == 'substructure' and structure:
-            for result in indexed.values():
-                if result.get('structure'):
-                    substructure_lookups.extend([structure for structure in result['structure']])
-            substructure_lookups = set(substructure_lookups)
-
-    # Filter valid lookups out of all (global) lookups
-    for q in queries:
-        if isinstance(q['lookups'], tuple):
-            field, field_lookup = q['lookups']
-            if field_lookup[1]:
-                valid_lookups[field] = lookups[field]
-            else:
-                valid_lookups[field] = [tup if tup[0] in field_lookup[0] else (tup[0], tup[1], True) for tup in lookups[field]]
+            valid_lookups[key] = options(lookups[key], index[key], mask)
 
     if lookups['subnational'].get(coverage):
-        if subnational_lookups:
-            valid_lookups['subnational'] = [
-                tup if tup[0] in subnational_lookups else (tup[0], tup[1], True)
-                for tup in lookups['subnational'][coverage]
-            ]
-        else:
-            valid_lookups['subnational'] = [(tup[0], tup[1], True) for tup in lookups['subnational'][coverage]]
+        valid_lookups['subnational'] = options(
+            lookups['subnational'][coverage], index['subnationalCoverage'], facet_mask('subnational'))
     else:
         valid_lookups['subnational'] = []
 
     if lookups['substructure'].get(structure):
-        if substructure_lookups:
-            valid_lookups['substructure'] = [
-                tup if tup[0] in substructure_lookups else (tup[0], tup[1], True)
-                for tup in lookups['substructure'][structure]
-            ]
-        else:
-            valid_lookups['substructure'] = [(tup[0], tup[1], True) for tup in lookups['substructure'][structure]]
+        valid_lookups['substructure'] = options(
+            lookups['substructure'][structure], index['structure'], facet_mask('substructure'))
     else:
         valid_lookups['substructure'] = []
 
     return valid_lookups
 
 
+def normalize_query(query):
+    '''The non-empty dropdown values of a query, as a hashable tuple'''
+    return tuple((key, query[key]) for key in QUERY_FIELDS if query.get(key))
+
+
+# Number of queries recommend_batch reads before scoring them, and the
+# largest queries × lists arrays it scores them in
+BATCH_SIZE = 10000
+BATCH_CHUNK_CELLS = 1000000
+
+
+def recommend_batch(queries, snapshot, limit=5):
+    '''Recommend lists for many queries at once, scoring them with NumPy.
+
+    queries is an iterable of dicts with the same keys as the results page.
+    Yields the recommendations for each query in turn: the first limit
+    lists in the order results shows them, as dicts of code, band,
+    relevance and quality. Queries are read BATCH_SIZE at a
+    time, and each distinct query is only scored once.
+    '''
+    features = snapshot.features
+    chunk_size = max(1, BATCH_CHUNK_CELLS // max(len(features), 1))
+    recommended = {}
+    queries = iter(queries)
+    while True:
+        batch = list(itertools.islice(queries, BATCH_SIZE))
+        if not batch:
+            return
+        normalized = [normalize_query(query) for query in batch]
+        new = [query for query in dict.fromkeys(normalized) if query not in recommended]
+        for start in range(0, len(new), chunk_size):
+            chunk = new[start:start + chunk_size]
+            keep, relevance, is_float = features.score([dict(query) for query in chunk])
+            bands = features.bands(keep, relevance)
+            for row, (query, positions) in enumerate(zip(chunk, features.ranked(bands, relevance, limit))):
+                recommended[query] = [
+                    {
+                        'code': features.codes[position],
+                        'band': BAND_NAMES[bands[row, position]],
+                        # The same type filter_and_score_results gives
+                        'relevance': float(relevance[row, position]) if is_float[row, position] else int(relevance[row, position]),
+                        'quality': snapshot.index['lists'][position]['quality'],
+                    }
+                    for position in positions
+                ]
+        for key in normalized:
+            yield recommended[key]
+
+
+def cached_query(function, query, snapshot):
+    '''Call filter_and_score_results or get_lookups through query_cache.
+
+    Both only depend on the snapshot and the dropdown values, so the key
+    is the branch, the version of its data and the non-empty dropdown values.
+    '''
+    key = (snapshot.branch, snapshot.version, function.__name__, normalize_query(query))
+    with timing.span(function.__name__):
+        return query_cache.get_or_set(key, lambda: function(query, snapshot))
+
+
 def update_lists(request):
-    return HttpResponse(refresh_data())
+    '''Start refreshing main in the background and report on it straight away'''
+    status = refresher.request('main')
+    snapshot = snapshots.peek('main')
+    status['sha'] = snapshot.sha if snapshot else None
+    return JsonResponse(status)
+
+
+def cache_stats(request):
+    return JsonResponse(query_cache.stats())
+
+
+def metrics(request):
+    return HttpResponse(timing.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def snapshot_report(request):
+    return JsonResponse({'branches': snapshots.report(), 'startup': startup_timings})
 
 
 def preview_branch(request,branch_name):
     print("Loading branch "+ branch_name)
-    refresh_data(branch_name)
+    refresher.request(branch_name)
     request.session['branch'] = branch_name
     return redirect('home')
 
 
 def home(request):
     use_branch = request.session.get('branch', 'main')
+    snapshot = get_snapshot(use_branch)
     query = {key: value for key, value in request.GET.items() if value and value != 'all'}
     context = {
         'lookups': {
-            'coverage': lookups['coverage'],
-            'structure': lookups['structure'],
-            'sector': lookups['sector']
+            'coverage': snapshot.lookups['coverage'],
+            'structure': snapshot.lookups['structure'],
+            'sector': snapshot.lookups['sector']
         }
     }
     if query:
-        context['lookups'] = get_lookups(query, use_branch)
+        context['lookups'] = cached_query(get_lookups, query, snapshot)
         context['query'] = query
     else:
         context['query'] = False
@@ -472,96 +982,480 @@ def home(request):
     context['local'] = settings.LOCAL_DATA
     context['branch'] = use_branch
 
-    return render(request, "home.html", context=context)
+    with timing.span('render'):
+        return render(request, "home.html", context=context)
 
 
 def results(request):
     use_branch = request.session.get('branch', 'main')
+    snapshot = get_snapshot(use_branch)
     query = {key: value for key, value in request.GET.items() if value and value != 'all'}
     context = {
         'lookups': {
-            'coverage': lookups['coverage'],
-            'structure': lookups['structure'],
-            'sector': lookups['sector']
+            'coverage': snapshot.lookups['coverage'],
+            'structure': snapshot.lookups['structure'],
+            'sector': snapshot.lookups['sector']
         },
-        'all_results': filter_and_score_results(query, branch)
+        'all_results': cached_query(filter_and_score_results, query, snapshot)
     }
 
     if query:
-        context['lookups'] = get_lookups(query, branch)
+        context['lookups'] = cached_query(get_lookups, query, snapshot)
 
     context['branch'] = use_branch
 
-    return render(request, 'results.html', context=context)
+    with timing.span('render'):
+        return render(request, 'results.html', context=context)
+
+
+# Fields worked out for each result rather than stored in the register
+API_COMPUTED_FIELDS = (
+    'relevance', 'relevance_debug', 'coverage_titles', 'coverage_codes_and_titles',
+    'subnationalCoverage_titles', 'structure_titles', 'sector_titles',
+)
+API_DEFAULT_FIELDS = ('code', 'name', 'quality', 'relevance')
+API_DEFAULT_LIMIT = 50
+API_MAX_LIMIT = 1000
+API_PARAMETERS = ('fields', 'limit', 'offset')
+
+
+def _project(result, fields):
+    '''Get the value of each field of a result, following paths like name/en'''
+    projected = {}
+    for field in fields:
+        path = field.split('/')
+        value = result.get(path[0])
+        for key in path[1:]:
+            value = value.get(key) if isinstance(value, Mapping) else None
+        projected[field] = to_plain(value)
+    return projected
+
+
+def _unknown_fields(fields, snapshot, computed=API_COMPUTED_FIELDS):
+    '''Get the fields that are not computed and not a column of the CSV download, or above one like name'''
+    headers = snapshot.csv_headers
+    return [
+        field for field in fields
+        if field not in computed and field not in headers and not any(header.startswith(field + '/') for header in headers)
+    ]
+
+
+def api_results(request):
+    '''The results page as JSON, e.g. ?coverage=GB&fields=code,name/en&limit=10
+
+    Results are ranked suggested, then recommended, then other, and limit
+    and offset page through that ranking. Only the requested fields are
+    returned, as dropdown values are in results.html.
+    '''
+    use_branch = request.session.get('branch', 'main')
+    snapshot = get_snapshot(use_branch)
+    query = {key: value for key, value in request.GET.items() if value and value != 'all' and key not in API_PARAMETERS}
+
+    try:
+        limit = min(int(request.GET.get('limit', API_DEFAULT_LIMIT)), API_MAX_LIMIT)
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        return HttpResponseBadRequest('limit and offset must be whole numbers')
+    if limit < 0 or offset < 0:
+        return HttpResponseBadRequest('limit and offset must not be negative')
+
+    fields = request.GET.get('fields')
+    fields = [field.strip() for field in fields.split(',') if field.strip()] if fields else API_DEFAULT_FIELDS
+    unknown = _unknown_fields(fields, snapshot)
+    if unknown:
+        return HttpResponseBadRequest('Unknown fields: {}'.format(', '.join(unknown)))
+
+    all_results = cached_query(filter_and_score_results, query, snapshot)
+    bands = ('suggested', 'recommended', 'other')
+    ranked = [result for band in bands for result in all_results[band]]
+    page = {band: [] for band in bands}
+    for result in ranked[offset:offset + limit]:
+        page[result.band].append(_project(result, fields))
+
+    return JsonResponse({
+        'query': query,
+        'branch': use_branch,
+        'sha': snapshot.sha,
+        'total': len(ranked),
+        'counts': {band: len(all_results[band]) for band in bands},
+        'offset': offset,
+        'limit': limit,
+        'results': page,
+    })
+
+
+BATCH_DEFAULT_LIMIT = 5
+BATCH_MAX_LIMIT = 100
+BATCH_CSV_COLUMNS = ('rank', 'code', 'band', 'relevance', 'quality')
+
+
+def _batch_query(row):
+    return {key: str(row[key]) for key in QUERY_FIELDS if row.get(key) and row[key] != 'all'}
+
+
+@csrf_exempt
+@require_POST
+def api_recommend(request):
+    '''Recommend lists for many queries, each with the same keys as the results page.
+
+    Queries are posted as a JSON array of objects, or as CSV with a header
+    row, either as a file upload named file or as the request body, which
+    Django limits to DATA_UPLOAD_MAX_MEMORY_SIZE, so large files should be
+    uploaded. Uploads are JSON if they have a JSON content type or a .json
+    name, and CSV otherwise; either has to be UTF-8. ?limit=
+    sets how many lists to recommend for each (default 5). The answer is
+    streamed in the same format: for JSON an array of {"query", "results"},
+    for CSV the columns of each query followed by BATCH_CSV_COLUMNS, with a
+    row per recommended list.
+    '''
+    snapshot = get_snapshot(request.session.get('branch', 'main'))
+    try:
+        limit = min(int(request.GET.get('limit', BATCH_DEFAULT_LIMIT)), BATCH_MAX_LIMIT)
+    except ValueError:
+        return HttpResponseBadRequest('limit must be a whole number')
+    if limit < 0:
+        return HttpResponseBadRequest('limit must not be negative')
+
+    upload = request.FILES.get('file')
+    if upload is None:
+        is_json = request.content_type == 'application/json'
+    else:
+        is_json = upload.content_type == 'application/json' or upload.name.lower().endswith('.json')
+    if is_json:
+        try:
+            rows = json.loads(request.body if upload is None else upload.read())
+        except ValueError:
+            return HttpResponseBadRequest('Invalid JSON')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return HttpResponseBadRequest('Expected a JSON array of objects')
+        return StreamingHttpResponse(_iter_batch_json(rows, snapshot, limit), content_type='application/json')
+
+    # Checked before streaming starts, so encoding errors are not found half way through the answer
+    if upload is not None:
+        if not _is_utf8(upload.file):
+            return HttpResponseBadRequest('Expected UTF-8')
+        reader = csv.DictReader(io.TextIOWrapper(upload.file, encoding='utf-8-sig'))
+    else:
+        try:
+            reader = csv.DictReader(io.StringIO(request.body.decode('utf-8-sig')))
+        except UnicodeDecodeError:
+            return HttpResponseBadRequest('Expected UTF-8')
+    return StreamingHttpResponse(_iter_batch_csv(reader, snapshot, limit), content_type='text/csv')
+
+
+def _is_utf8(file, chunk_size=64 * 1024):
+    '''Check that a file decodes as UTF-8 a chunk at a time, leaving it at the start'''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    finally:
+        file.seek(0)
+    return True
+
+
+def _iter_batch_json(rows, snapshot, limit):
+    yield '['
+    recommendations = recommend_batch((_batch_query(row) for row in rows), snapshot, limit)
+    for number, (row, results) in enumerate(zip(rows, recommendations)):
+        yield (',\n' if number else '\n') + json.dumps({'query': row, 'results': results})
+    yield '\n]\n'
+
+
+def _iter_batch_csv(reader, snapshot, limit):
+    rows, query_rows = itertools.tee(reader)
+    recommendations = recommend_batch((_batch_query(row) for row in query_rows), snapshot, limit)
+    writer = csv.writer(_Echo())
+    columns = list(reader.fieldnames or [])
+    yield writer.writerow(columns + list(BATCH_CSV_COLUMNS))
+    for row, results in zip(rows, recommendations):
+        values = [row.get(column) for column in columns]
+        if not results:
+            yield writer.writerow(values)
+        for rank, result in enumerate(results, 1):
+            yield writer.writerow(values + [rank] + [result[column] for column in BATCH_CSV_COLUMNS[1:]])
+
+
+def _resolve(snapshot, identifier):
+    match = snapshot.prefixes.resolve(identifier)
+    if match is None:
+        return None
+    code, former_prefix, prefix, local_id = match
+    return {
+        'identifier': identifier,
+        'code': code,
+        'prefix': prefix,
+        'id': local_id,
+        'former_prefix': former_prefix,
+        'deprecated': bool(snapshot.lists[code].get('deprecated')),
+    }
+
+
+def api_resolve(request):
+    '''Find the list an identifier belongs to, e.g. ?identifier=GB-COH-09506232, and return it'''
+    snapshot = get_snapshot(request.session.get('branch', 'main'))
+    identifier = request.GET.get('identifier', '').strip()
+    if not identifier:
+        return HttpResponseBadRequest('No identifier given')
+    resolved = _resolve(snapshot, identifier)
+    if resolved is None:
+        return JsonResponse({'identifier': identifier, 'error': 'No organization list matches this identifier'}, status=404)
+    resolved['list'] = dict(to_plain(snapshot.lists[resolved['code']]), **snapshot.titles[resolved['code']])
+    return JsonResponse(resolved)
+
+
+RESOLVE_CSV_COLUMNS = ('identifier', 'code', 'prefix', 'id', 'former_prefix', 'deprecated', 'name')
+# Number of CSV rows api_resolve_bulk sends at a time
+RESOLVE_CHUNK_ROWS = 1000
+
+
+@csrf_exempt
+@require_POST
+def api_resolve_bulk(request):
+    '''Resolve identifiers posted one per line, as a file upload named file or the body.
+
+    Streams back a CSV row of RESOLVE_CSV_COLUMNS for each identifier, in
+    the order they were posted. Identifiers that match no list only have
+    the identifier column filled in. Uploads are read as they are resolved,
+    while the body is limited to DATA_UPLOAD_MAX_MEMORY_SIZE, so large
+    files should be uploaded.
+    '''
+    snapshot = get_snapshot(request.session.get('branch', 'main'))
+    lines = request.FILES.get('file') or request
+    return StreamingHttpResponse(_iter_resolved(lines, snapshot), content_type='text/csv')
+
+
+def _iter_resolved(lines, snapshot):
+    resolve = snapshot.prefixes.resolve
+    org_id_lists = snapshot.lists
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(RESOLVE_CSV_COLUMNS)
+    for number, line in enumerate(lines, 1):
+        identifier = line.decode('utf-8-sig').strip()
+        if not identifier:
+            continue
+        match = resolve(identifier)
+        if match is None:
+            writer.writerow((identifier,))
+        else:
+            code, former_prefix, prefix, local_id = match
+            org_list = org_id_lists[code]
+            writer.writerow((identifier, code, prefix, local_id, former_prefix, bool(org_list.get('deprecated')), (org_list.get('name') or {}).get('en')))
+        if number % RESOLVE_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# Titles come with search results, but not relevance, which depends on a query of the results page
+SEARCH_COMPUTED_FIELDS = tuple(field for field in API_COMPUTED_FIELDS if not field.startswith('relevance'))
+SEARCH_DEFAULT_FIELDS = ('code', 'name', 'quality')
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 100
+
+
+def api_search(request):
+    '''Find lists by name, description, code or former prefix, e.g. ?q=companies hou
+
+    The last word matches the start of longer words, so this can be used
+    for autocomplete; add prefix=false to only match whole words. Lists
+    have to match every word, and are ranked by how well they match and
+    their quality. limit and fields are as for api_results, except that
+    there is no relevance, but a score.
+    '''
+    use_branch = request.session.get('branch', 'main')
+    snapshot = get_snapshot(use_branch)
+    text = request.GET.get('q', '')
+    try:
+        limit = min(int(request.GET.get('limit', SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+    except ValueError:
+        return HttpResponseBadRequest('limit must be a whole number')
+    if limit < 0:
+        return HttpResponseBadRequest('limit must not be negative')
+    fields = request.GET.get('fields')
+    fields = [field.strip() for field in fields.split(',') if field.strip()] if fields else SEARCH_DEFAULT_FIELDS
+    unknown = _unknown_fields(fields, snapshot, SEARCH_COMPUTED_FIELDS)
+    if unknown:
+        return HttpResponseBadRequest('Unknown fields: {}'.format(', '.join(unknown)))
+
+    with timing.span('search'):
+        matches = snapshot.search.search(text, limit, prefix=request.GET.get('prefix') != 'false')
+    results = []
+    for code, score in matches:
+        result = _project(dict(snapshot.lists[code], **snapshot.titles[code]), fields)
+        result['score'] = round(score, 4)
+        results.append(result)
+    return JsonResponse({'q': text, 'branch': use_branch, 'sha': snapshot.sha, 'results': results})
 
 
 def list_details(request, prefix):
     use_branch = request.session.get('branch', 'main')
+    snapshot = get_snapshot(use_branch)
 
     try:
-        org_list = org_id_dict[use_branch][prefix].copy()
-        add_titles(org_list)
+        org_list = dict(snapshot.lists[prefix], **snapshot.titles[prefix])
 
     except KeyError:
         raise Http404('Organization list {} does not exist'.format(prefix))
-    return render(request, 'list.html', context={'org_list': org_list, 'lookups': lookups, 'branch':use_branch})
+    return render(request, 'list.html', context={'org_list': org_list, 'lookups': snapshot.lookups, 'branch':use_branch})
 
 
-def _get_filename(use_branch='main'):
-    if git_commit_ref[use_branch]:
-        return git_commit_ref[use_branch][:10]
+def _get_filename(snapshot):
+    if snapshot.sha:
+        return snapshot.sha[:10]
     else:
         return datetime.datetime.now().strftime("%Y%m%d%H%M%S")
 
 
-def json_download(request):
-    use_branch = request.session.get('branch', 'main')
-    response = HttpResponse(json.dumps({"lists": list(org_id_dict[use_branch].values())}, indent=2), content_type='text/json')
-    response['Content-Disposition'] = 'attachment; filename="org-id-{0}.json"'.format(_get_filename())
+Artifact = namedtuple('Artifact', ('content', 'gzip_content', 'content_type', 'filename', 'etag', 'last_modified'))
+
+ARTIFACT_CONTENT_TYPES = {
+    'json': 'text/json',
+    'csv': 'text/csv',
+    'xml': 'text/xml',
+}
+
+
+def make_json_download(snapshot):
+    return json.dumps({"lists": [to_plain(org_id_list) for org_id_list in snapshot.lists.values()]}, indent=2)
+
+
+def get_artifact(kind, snapshot):
+    '''Get the json, csv or xml download for a snapshot, building it on first use.
+
+    Downloads are kept, raw and gzipped, for the life of the snapshot.
+    '''
+    artifact = snapshot.artifacts.get(kind)
+    if artifact is None:
+        content = ARTIFACT_BUILDERS[kind](snapshot).encode('utf-8')
+        version = snapshot.sha or hashlib.md5(content).hexdigest()
+        artifact = Artifact(
+            content=content,
+            gzip_content=gzip.compress(content, mtime=0),
+            content_type=ARTIFACT_CONTENT_TYPES[kind],
+            filename='org-id-{0}.{1}'.format(_get_filename(snapshot), kind),
+            etag='"{0}-{1}"'.format(version, kind),
+            last_modified=snapshot.changed_at,
+        )
+        snapshot.artifacts[kind] = artifact
+    return artifact
+
+
+def _accepts_gzip(accept_encoding):
+    '''Whether an Accept-Encoding header allows gzip, which it does not with q=0'''
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, *parameters = [part.strip() for part in coding.split(';')]
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0)) > 0
+
+
+def artifact_response(request, kind):
+    '''Serve a download, answering conditional requests with 304 and using gzip if accepted'''
+    artifact = get_artifact(kind, get_snapshot(request.session.get('branch', 'main')))
+    last_modified = int(artifact.last_modified.timestamp())
+    use_gzip = _accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    # The gzipped download is a different representation, so has its own ETag
+    etag = artifact.etag[:-1] + '-gzip"' if use_gzip else artifact.etag
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if use_gzip:
+            response = HttpResponse(artifact.gzip_content, content_type=artifact.content_type)
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(artifact.content, content_type=artifact.content_type)
+        response['Content-Disposition'] = 'attachment; filename="{0}"'.format(artifact.filename)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(response, ('Accept-Encoding',))
     return response
 
 
+def json_download(request):
+    return artifact_response(request, 'json')
+
+
 def _flatten_list(obj, path=''):
     # probably use flattentool but only when schema data validates
     for key, value in obj.items():
-        if isinstance(value, dict):
+        if isinstance(value, Mapping):
             yield from _flatten_list(value, path + "/" + key)
-        elif isinstance(value, list):
+        elif isinstance(value, (list, tuple)):
             yield (path + "/" + key).lstrip("/"), ", ".join(value)
         else:
             yield (path + "/" + key).lstrip("/"), value
 
 
-def csv_download(request):
-    use_branch = request.session.get('branch', 'main')
+def list_columns(org_id_list):
+    '''Get the flattened paths used by a list, as columns of the CSV download'''
+    return frozenset(key for key, value in _flatten_list(org_id_list))
+
+
+def get_csv_headers(columns):
+    '''Get the columns of the CSV download: every flattened path used by any list, given those of each list'''
     all_keys = set()
-    all_rows = []
-    for item in org_id_dict[use_branch].values():
-        row = dict(_flatten_list(item))
-        all_keys.update(row.keys())
-        all_rows.append(row)
+    for paths in columns:
+        all_keys.update(paths)
+
+    all_keys.discard("code")
+    all_keys.discard("description/en")
+
+    return ["code", "description/en"] + sorted(list(all_keys))
 
-    all_keys.remove("code")
-    all_keys.remove("description/en")
 
-    headers = ["code", "description/en"] + sorted(list(all_keys))
+class _Echo:
+    '''File-like object that hands back what is written, for streaming csv'''
+    def write(self, value):
+        return value
 
-    output = io.StringIO()
 
-    writer = csv.DictWriter(output, headers)
-    writer.writeheader()
-    writer.writerows(all_rows)
+def iter_csv_rows(snapshot, headers=None):
+    '''Yield the CSV download line by line, optionally only with the given headers'''
+    writer = csv.DictWriter(_Echo(), headers or snapshot.csv_headers, extrasaction='ignore')
+    yield writer.writeheader()
+    for item in snapshot.lists.values():
+        yield writer.writerow(dict(_flatten_list(item)))
 
-    response = HttpResponse(output.getvalue(), content_type='text/csv')
 
-    response['Content-Disposition'] = 'attachment; filename="org-id-{0}.csv"'.format(_get_filename(use_branch))
+def make_csv_download(snapshot):
+    return ''.join(iter_csv_rows(snapshot))
+
+
+def csv_download(request):
+    fields = request.GET.get('fields')
+    if not fields:
+        return artifact_response(request, 'csv')
+
+    # Stream just the requested columns, e.g. ?fields=code,name/en,coverage
+    snapshot = get_snapshot(request.session.get('branch', 'main'))
+    headers = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in headers if field not in snapshot.csv_headers]
+    if unknown:
+        return HttpResponseBadRequest('Unknown fields: {}'.format(', '.join(unknown)))
+
+    response = StreamingHttpResponse(iter_csv_rows(snapshot, headers), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="org-id-{0}.csv"'.format(_get_filename(snapshot))
     return response
 
 
 import lxml.etree as ET
 
 
-def make_xml_codelist(use_branch="main"):
+def make_xml_codelist(snapshot):
     root = ET.Element("codelist")
     meta = ET.SubElement(root, "metadata")
     ET.SubElement(ET.SubElement(meta, "name"),"narrative").text = "Organization Identifier Lists"
@@ -579,7 +1473,7 @@ def make_xml_codelist(use_branch="main"):
     """
     items = ET.SubElement(root, "codelist-items")
 
-    for entry in sorted(org_id_dict[use_branch].values(), key=lambda entry: entry['code']):
+    for entry in sorted(snapshot.lists.values(), key=lambda entry: entry['code']):
         if entry.get('access') and entry['access'].get('availableOnline'):
             publicdb = str(1)
         else:
@@ -611,7 +1505,11 @@ def make_xml_codelist(use_branch="main"):
 
 
 def xml_download(request):
-    use_branch = request.session.get('branch', 'main')
-    response = HttpResponse(make_xml_codelist(use_branch), content_type='text/xml')
-    response['Content-Disposition'] = 'attachment; filename="org-id-{0}.xml"'.format(_get_filename())
-    return response
+    return artifact_response(request, 'xml')
+
+
+ARTIFACT_BUILDERS = {
+    'json': make_json_download,
+    'csv': make_csv_download,
+    'xml': make_xml_codelist,
+}
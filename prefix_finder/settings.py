@@ -32,8 +32,25 @@ env = environ.Env(  # set default values and casting
     SECRET_KEY=(str, secret_key),
     DB_NAME=(str, os.path.join(BASE_DIR, 'db.sqlite3')),
     LOCAL_DATA=(bool, False),
+    LOCAL_DATA_DIR=(str, BASE_DIR),
     GITHUB_USER=(str, ''),
     GITHUB_API_TOKEN=(str, ''),
+    GITHUB_ARCHIVE_URL=(str, 'https://github.com/org-id/register/archive/{branch}.zip'),
+    GITHUB_BRANCH_API_URL=(str, 'https://api.github.com/repos/org-id/register/branches/{branch}'),
+    GITHUB_TIMEOUT=(float, 30),
+    GITHUB_RETRIES=(int, 3),
+    GIT_MIRROR_DIR=(str, ''),
+    GIT_MIRROR_FETCH=(bool, False),
+    LOAD_WORKERS=(int, 0),
+    REFRESH_INTERVAL=(int, 5 * 60),
+    REFRESH_JITTER=(int, 60),
+    SHARED_SNAPSHOT_DIR=(str, ''),
+    SNAPSHOT_MAX_BRANCHES=(int, 10),
+    SNAPSHOT_IDLE_TTL=(int, 6 * 60 * 60),
+    SNAPSHOT_MEMORY_BUDGET_MB=(int, 1024),
+    QUERY_CACHE_SIZE=(int, 1024),
+    SCORING_ENGINE=(str, 'python'),
+    QUERY_CACHE_BACKEND=(str, ''),
 )
 
 PIWIK = {
@@ -42,9 +59,55 @@ PIWIK = {
 }
 
 LOCAL_DATA = env('LOCAL_DATA')
+# Directory holding the schema/ and lists/ folders used when not loading from GitHub
+LOCAL_DATA_DIR = env('LOCAL_DATA_DIR')
 GITHUB_USER = env('GITHUB_USER')
 GITHUB_API_TOKEN = env('GITHUB_API_TOKEN')
 
+# Where the register is fetched from, with {branch} filled in
+GITHUB_ARCHIVE_URL = env('GITHUB_ARCHIVE_URL')
+GITHUB_BRANCH_API_URL = env('GITHUB_BRANCH_API_URL')
+GITHUB_TIMEOUT = env('GITHUB_TIMEOUT')
+GITHUB_RETRIES = env('GITHUB_RETRIES')
+
+# A bare clone of the register (git clone --mirror) to load branches from
+# instead of GitHub, and whether to fetch into it before each refresh
+GIT_MIRROR_DIR = env('GIT_MIRROR_DIR')
+GIT_MIRROR_FETCH = env('GIT_MIRROR_FETCH')
+
+# Threads used to read and parse the files of the register when loading a
+# branch, by default one per CPU up to 4 (1 reads them one at a time). orjson
+# is used to parse them if it is installed, otherwise json
+LOAD_WORKERS = env('LOAD_WORKERS') or min(4, os.cpu_count() or 1)
+
+# How often loaded branches are checked for new commits in the background,
+# in seconds (0 turns this off), plus a random delay of up to REFRESH_JITTER.
+# With SHARED_SNAPSHOT_DIR set, GitHub is only asked about each branch once
+# per interval, by whichever worker gets there first
+REFRESH_INTERVAL = env('REFRESH_INTERVAL')
+REFRESH_JITTER = env('REFRESH_JITTER')
+
+# Directory where loaded snapshots are saved for all workers to share, so
+# only one of them downloads each commit, off if empty (the default). It must
+# belong to the user the application runs as and not be writable by others,
+# e.g. a directory of its own rather than the shared /tmp
+SHARED_SNAPSHOT_DIR = env('SHARED_SNAPSHOT_DIR')
+
+# Limits on the branches kept loaded for previews (main is always kept):
+# how many, how long they can go unused (seconds) and their total memory
+SNAPSHOT_MAX_BRANCHES = env('SNAPSHOT_MAX_BRANCHES')
+SNAPSHOT_IDLE_TTL = env('SNAPSHOT_IDLE_TTL')
+SNAPSHOT_MEMORY_BUDGET_MB = env('SNAPSHOT_MEMORY_BUDGET_MB')
+
+# Number of query results and lookups kept in memory per process, and
+# optionally the name of a Django cache (see CACHES) to share them through
+QUERY_CACHE_SIZE = env('QUERY_CACHE_SIZE')
+QUERY_CACHE_BACKEND = env('QUERY_CACHE_BACKEND')
+
+# How results are scored: 'python' scores each list in turn, 'numpy' scores
+# them all at once with arrays, which stays quicker as the register grows
+SCORING_ENGINE = env('SCORING_ENGINE')
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.8/howto/deployment/checklist/
 
@@ -77,6 +140,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE = (
+    'prefix_finder.frontend.timing.TimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',